@@ -24,6 +24,7 @@ from util import *
 import time, os
 import traceback
 import sys
+import hashlib
 
 #######################
 # Parts worth reading #
@@ -161,9 +162,11 @@ class AgentState:
 
 class Grid:
     """
-    A 2-dimensional array of objects backed by a list of lists.  Data is accessed
-    via grid[x][y] where (x,y) are positions on a Pacman map with x horizontal,
-    y vertical and the origin (0,0) in the bottom left corner.
+    A 2-dimensional array of booleans backed by the bits of a single int.  Data is
+    accessed via grid[x][y] where (x,y) are positions on a Pacman map with x horizontal,
+    y vertical and the origin (0,0) in the bottom left corner.  The bit of (x,y) is
+    x * height + y, so copying a grid copies one int and counting is a popcount.
+    grid.get(x, y) reads a cell without creating a column view.
 
     The __str__ method constructs an output that is oriented like a pacman board.
     """
@@ -173,57 +176,94 @@ class Grid:
 
         self.width = width
         self.height = height
-        self.data = [[initialValue for y in range(height)] for x in range(width)]
+        self.bits = (1 << (width * height)) - 1 if initialValue else 0
+        self.frozen = False
+        self._hash = None
+        self._columns = None
         if bitRepresentation:
             self._unpackBits(bitRepresentation)
 
     def __getitem__(self, i):
-        return self.data[i]
+        if i < 0: i += self.width
+        if not 0 <= i < self.width: raise IndexError('grid index out of range')
+        if self._columns is None: self._columns = [None] * self.width
+        column = self._columns[i]
+        if column is None:
+            column = self._columns[i] = GridColumn(self, i)
+        return column
+
+    def __len__(self):
+        return self.width
+
+    def __iter__(self):
+        for x in range(self.width):
+            yield self[x]
+
+    def get(self, x, y):
+        return self.bits >> (x * self.height + y) & 1 == 1
 
-    def __setitem__(self, key, item):
-        self.data[key] = item
+    def set(self, x, y, value):
+        if self.frozen: raise Exception('Frozen grids can not be changed, copy them first')
+        bit = 1 << (x * self.height + y)
+        if value:
+            self.bits |= bit
+        else:
+            self.bits &= ~bit
+        self._hash = None
 
     def __str__(self):
-        out = [[str(self.data[x][y])[0] for x in range(self.width)] for y in range(self.height)]
+        out = [[str(self.get(x, y))[0] for x in range(self.width)] for y in range(self.height)]
         out.reverse()
         return '\n'.join([''.join(x) for x in out])
 
     def __eq__(self, other):
         if other == None: return False
-        return self.data == other.data
+        return self.bits == other.bits and self.width == other.width and self.height == other.height
+
+    def __ne__(self, other):
+        return not self == other
 
     def __hash__(self):
-        # return hash(str(self))
-        base = 1
-        h = 0
-        for l in self.data:
-            for i in l:
-                if i:
-                    h += base
-                base *= 2
-        return hash(h)
+        # equal to hashing the sum of 2 ** (x * height + y) over the cells set
+        if self._hash is None:
+            self._hash = hash(self.bits)
+        return self._hash
+
+    def freeze(self):
+        """
+        Makes the grid read only. Copies of a frozen grid can be changed.
+        """
+        self.frozen = True
 
     def copy(self):
         g = Grid(self.width, self.height)
-        g.data = [x[:] for x in self.data]
+        g.bits = self.bits
+        g._hash = self._hash
         return g
 
     def deepCopy(self):
         return self.copy()
 
     def shallowCopy(self):
-        g = Grid(self.width, self.height)
-        g.data = self.data
-        return g
+        return self.copy()
 
     def count(self, item =True ):
-        return sum([x.count(item) for x in self.data])
+        trueCount = bin(self.bits).count('1')
+        if item: return trueCount
+        return self.width * self.height - trueCount
 
     def asList(self, key = True):
         list = []
+        if key:
+            bits = self.bits
+            while bits:
+                low = bits & -bits
+                list.append(self._cellIndexToPosition(low.bit_length() - 1))
+                bits ^= low
+            return list
         for x in range(self.width):
             for y in range(self.height):
-                if self[x][y] == key: list.append( (x,y) )
+                if self.get(x, y) == key: list.append( (x,y) )
         return list
 
     def packBits(self):
@@ -237,7 +277,7 @@ class Grid:
         for i in range(self.height * self.width):
             bit = self.CELLS_PER_INT - (i % self.CELLS_PER_INT) - 1
             x, y = self._cellIndexToPosition(i)
-            if self[x][y]:
+            if self.get(x, y):
                 currentInt += 2 ** bit
             if (i + 1) % self.CELLS_PER_INT == 0:
                 bits.append(currentInt)
@@ -259,7 +299,7 @@ class Grid:
             for bit in self._unpackInt(packed, self.CELLS_PER_INT):
                 if cell == self.width * self.height: break
                 x, y = self._cellIndexToPosition(cell)
-                self[x][y] = bit
+                self.set(x, y, bit)
                 cell += 1
 
     def _unpackInt(self, packed, size):
@@ -274,6 +314,38 @@ class Grid:
                 bools.append(False)
         return bools
 
+class GridColumn:
+    """
+    View of the column x of a Grid, so that cells can be read and written as
+    grid[x][y].
+    """
+    def __init__(self, grid, x):
+        self.grid = grid
+        self.x = x
+
+    def __getitem__(self, y):
+        if y < 0: y += self.grid.height
+        if not 0 <= y < self.grid.height: raise IndexError('grid index out of range')
+        return self.grid.get(self.x, y)
+
+    def __setitem__(self, y, value):
+        if y < 0: y += self.grid.height
+        if not 0 <= y < self.grid.height: raise IndexError('grid index out of range')
+        self.grid.set(self.x, y, value)
+
+    def __len__(self):
+        return self.grid.height
+
+    def __iter__(self):
+        for y in range(self.grid.height):
+            yield self.grid.get(self.x, y)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
 def reconstituteGrid(bitRep):
     if type(bitRep) is not type((1,2)):
         return bitRep
@@ -342,7 +414,7 @@ class Actions:
             dx, dy = vec
             next_y = y_int + dy
             next_x = x_int + dx
-            if not walls[next_x][next_y]: possible.append(dir)
+            if not walls.get(next_x, next_y): possible.append(dir)
 
         return possible
 
@@ -358,7 +430,7 @@ class Actions:
             if next_x < 0 or next_x == walls.width: continue
             next_y = y_int + dy
             if next_y < 0 or next_y == walls.height: continue
-            if not walls[next_x][next_y]: neighbors.append((next_x, next_y))
+            if not walls.get(next_x, next_y): neighbors.append((next_x, next_y))
         return neighbors
     getLegalNeighbors = staticmethod(getLegalNeighbors)
 
@@ -368,14 +440,45 @@ class Actions:
         return (x + dx, y + dy)
     getSuccessor = staticmethod(getSuccessor)
 
+ZOBRIST_MASK = (1 << 64) - 1
+ZOBRIST_KEYS = {}
+
+def zobristKey(*feature):
+    """
+    Returns the random 64 bit key of a feature of a game state, such as
+    ('food', x, y). Keys are taken from the md5 digest of the feature, so
+    they are the same in every process and every run.
+    """
+    key = ZOBRIST_KEYS.get(feature)
+    if key is None:
+        key = ZOBRIST_KEYS[feature] = int(hashlib.md5(repr(feature)).hexdigest()[:16], 16)
+    return key
+
+def agentStateKey(agentIndex, agentState):
+    "Returns the Zobrist key of the position, direction and scared timer of an agent"
+    configuration = agentState.configuration
+    if configuration == None:
+        key = zobristKey('agent', agentIndex, None, None)
+    else:
+        x, y = configuration.pos
+        key = zobristKey('agent', agentIndex, float(x), float(y), configuration.direction)
+    return key ^ zobristKey('scared', agentIndex, agentState.scaredTimer)
+
 class GameStateData:
     """
+    The food, capsules, agent states and score of a game state.
 
+    A state carries a Zobrist hash of its food, capsules and agent states,
+    which generateSuccessor updates from the changes of each move, see
+    updateZobrist. stateKey combines it with the score into a 64 bit key
+    that is stable across processes. Data changed outside of
+    generateSuccessor must call resetZobrist.
     """
     def __init__( self, prevState = None ):
         """
         Generates a new data packet by copying information from its predecessor.
         """
+        self._zobrist = None
         if prevState != None:
             self.food = prevState.food.shallowCopy()
             self.capsules = prevState.capsules[:]
@@ -383,6 +486,7 @@ class GameStateData:
             self.layout = prevState.layout
             self._eaten = prevState._eaten
             self.score = prevState.score
+            self._zobrist = prevState._zobrist
 
         self._foodEaten = None
         self._foodAdded = None
@@ -390,12 +494,13 @@ class GameStateData:
         self._agentMoved = None
         self._lose = False
         self._win = False
+        self._truncated = False
         self.scoreChange = 0
 
     def deepCopy( self ):
         state = GameStateData( self )
         state.food = self.food.deepCopy()
-        state.layout = self.layout.deepCopy()
+        state.layout = self.layout
         state._agentMoved = self._agentMoved
         state._foodEaten = self._foodEaten
         state._foodAdded = self._foodAdded
@@ -424,23 +529,66 @@ class GameStateData:
         """
         Allows states to be keys of dictionaries.
         """
-        for i, state in enumerate( self.agentStates ):
-            try:
-                int(hash(state))
-            except TypeError, e:
-                print e
-                #hash(state)
-        return int((hash(tuple(self.agentStates)) + 13*hash(self.food) + 113* hash(tuple(self.capsules)) + 7 * hash(self.score)) % 1048575 )
+        return hash( self.stateKey() )
+
+    def stateKey( self ):
+        """
+        Returns a 64 bit key of the state, equal for equal states and the
+        same in every process and every run.
+        """
+        if self._zobrist is None:
+            self._zobrist = self.computeZobrist()
+        return (self._zobrist ^ int(self.score) * 0x9E3779B97F4A7C15) & ZOBRIST_MASK
+
+    def computeZobrist( self ):
+        "Computes the Zobrist hash of the food, capsules and agent states from scratch"
+        key = 0
+        for x, y in self.food.asList():
+            key ^= zobristKey('food', x, y)
+        for x, y in self.capsules:
+            key ^= zobristKey('capsule', x, y)
+        for agentIndex, agentState in enumerate( self.agentStates ):
+            key ^= agentStateKey(agentIndex, agentState)
+        return key
+
+    def updateZobrist( self, prevState ):
+        """
+        Updates the Zobrist hash copied from the predecessor prevState with
+        the food, capsules and agent states that changed since.
+        """
+        key = prevState._zobrist
+        if key is None:
+            self._zobrist = None
+            return
+        eaten = self.food.bits ^ prevState.food.bits
+        while eaten:
+            low = eaten & -eaten
+            x, y = self.food._cellIndexToPosition(low.bit_length() - 1)
+            key ^= zobristKey('food', x, y)
+            eaten ^= low
+        if len(self.capsules) != len(prevState.capsules):
+            for x, y in set(self.capsules).symmetric_difference(prevState.capsules):
+                key ^= zobristKey('capsule', x, y)
+        for agentIndex, agentState in enumerate( self.agentStates ):
+            prevAgentState = prevState.agentStates[agentIndex]
+            if agentState.configuration is not prevAgentState.configuration or \
+               agentState.scaredTimer != prevAgentState.scaredTimer:
+                key ^= agentStateKey(agentIndex, prevAgentState) ^ agentStateKey(agentIndex, agentState)
+        self._zobrist = key
+
+    def resetZobrist( self ):
+        "Makes the next stateKey compute the Zobrist hash from scratch"
+        self._zobrist = None
 
     def __str__( self ):
         width, height = self.layout.width, self.layout.height
-        map = Grid(width, height)
+        map = [[' ' for y in range(height)] for x in range(width)]
         if type(self.food) == type((1,2)):
             self.food = reconstituteGrid(self.food)
         for x in range(width):
             for y in range(height):
                 food, walls = self.food, self.layout.walls
-                map[x][y] = self._foodWallStr(food[x][y], walls[x][y])
+                map[x][y] = self._foodWallStr(food.get(x, y), walls.get(x, y))
 
         for agentState in self.agentStates:
             if agentState == None: continue
@@ -455,7 +603,9 @@ class GameStateData:
         for x, y in self.capsules:
             map[x][y] = 'o'
 
-        return str(map) + ("\nScore: %d\n" % self.score)
+        rows = [''.join([map[x][y] for x in range(width)]) for y in range(height)]
+        rows.reverse()
+        return '\n'.join(rows) + ("\nScore: %d\n" % self.score)
 
     def _foodWallStr( self, hasFood, hasWall ):
         if hasFood:
@@ -503,6 +653,7 @@ class GameStateData:
                 else: numGhosts += 1
             self.agentStates.append( AgentState( Configuration( pos, Directions.STOP), isPacman) )
         self._eaten = [False for a in self.agentStates]
+        self._zobrist = self.computeZobrist()
 
 try:
     import boinc
@@ -515,7 +666,7 @@ class Game:
     The Game manages the control flow, soliciting actions from agents.
     """
 
-    def __init__( self, agents, display, rules, startingIndex=0, muteAgents=False, catchExceptions=False ):
+    def __init__( self, agents, display, rules, startingIndex=0, muteAgents=False, catchExceptions=False, readOnlyObservations=False ):
         self.agentCrashed = False
         self.agents = agents
         self.display = display
@@ -524,6 +675,8 @@ class Game:
         self.gameOver = False
         self.muteAgents = muteAgents
         self.catchExceptions = catchExceptions
+        # agents observe states through state.readOnlyView() instead of copies
+        self.readOnlyObservations = readOnlyObservations
         self.moveHistory = []
         self.totalAgentTimes = [0 for agent in agents]
         self.totalAgentTimeWarnings = [0 for agent in agents]
@@ -537,6 +690,12 @@ class Game:
         else:
             return self.rules.getProgress(self)
 
+    def observe( self ):
+        "Returns the observation of the current state handed to the agents"
+        if self.readOnlyObservations:
+            return self.state.readOnlyView()
+        return self.state.deepCopy()
+
     def _agentCrash( self, agentIndex, quiet=False):
         "Helper method for handling agent crashes"
         if not quiet: traceback.print_exc()
@@ -570,6 +729,7 @@ class Game:
         """
         self.display.initialize(self.state.data)
         self.numMoves = 0
+        self.startTime = time.time()
 
         ###self.display.initialize(self.state.makeObservation(1).data)
         # inform learning agents of the game start
@@ -590,7 +750,7 @@ class Game:
                         timed_func = TimeoutFunction(agent.registerInitialState, int(self.rules.getMaxStartupTime(i)))
                         try:
                             start_time = time.time()
-                            timed_func(self.state.deepCopy())
+                            timed_func(self.observe())
                             time_taken = time.time() - start_time
                             self.totalAgentTimes[i] += time_taken
                         except TimeoutFunctionException:
@@ -604,7 +764,7 @@ class Game:
                         self.unmute()
                         return
                 else:
-                    agent.registerInitialState(self.state.deepCopy())
+                    agent.registerInitialState(self.observe())
                 ## TODO: could this exceed the total time
                 self.unmute()
 
@@ -624,7 +784,7 @@ class Game:
                         timed_func = TimeoutFunction(agent.observationFunction, int(self.rules.getMoveTimeout(agentIndex)))
                         try:
                             start_time = time.time()
-                            observation = timed_func(self.state.deepCopy())
+                            observation = timed_func(self.observe())
                         except TimeoutFunctionException:
                             skip_action = True
                         move_time += time.time() - start_time
@@ -634,10 +794,10 @@ class Game:
                         self.unmute()
                         return
                 else:
-                    observation = agent.observationFunction(self.state.deepCopy())
+                    observation = agent.observationFunction(self.observe())
                 self.unmute()
             else:
-                observation = self.state.deepCopy()
+                observation = self.observe()
 
             # Solicit an action
             action = None
@@ -704,10 +864,10 @@ class Game:
             ###idx = agentIndex - agentIndex % 2 + 1
             ###self.display.update( self.state.makeObservation(idx).data )
 
+            # Track progress, counting a move once every agent has moved
+            if agentIndex == numAgents - 1: self.numMoves += 1
             # Allow for game specific conditions (winning, losing, etc.)
             self.rules.process(self.state, self)
-            # Track progress
-            if agentIndex == numAgents + 1: self.numMoves += 1
             # Next agent
             agentIndex = ( agentIndex + 1 ) % numAgents
 
@@ -727,3 +887,44 @@ class Game:
                     self.unmute()
                     return
         self.display.finish()
+
+    def runHeadless( self, recordHistory=False ):
+        """
+        Control loop for games without display, muted agents, time limits or
+        exception handling, such as quiet training episodes. Plays like run,
+        but looks up the methods of the agents once, never updates the display
+        and records the moves in moveHistory only if recordHistory is set.
+        The moves of the game are not added to the explored states.
+        """
+        if None in self.agents or self.muteAgents or self.catchExceptions:
+            return self.run()
+        self.numMoves = 0
+        self.startTime = time.time()
+
+        for agent in self.agents:
+            if hasattr(agent, 'registerInitialState'):
+                agent.registerInitialState(self.observe())
+
+        observers = [getattr(agent, 'observationFunction', None) for agent in self.agents]
+        actors = [agent.getAction for agent in self.agents]
+        rules = self.rules
+        agentIndex = self.startingIndex
+        numAgents = len( self.agents )
+
+        while not self.gameOver:
+            observation = self.observe()
+            observer = observers[agentIndex]
+            if observer is not None:
+                observation = observer(observation)
+            action = actors[agentIndex](observation)
+            if recordHistory:
+                self.moveHistory.append( (agentIndex, action) )
+            self.state = self.state.generateSuccessor( agentIndex, action, False )
+
+            if agentIndex == numAgents - 1: self.numMoves += 1
+            rules.process(self.state, self)
+            agentIndex = ( agentIndex + 1 ) % numAgents
+
+        for agent in self.agents:
+            if hasattr(agent, 'final'):
+                agent.final( self.state )
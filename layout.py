@@ -22,6 +22,10 @@ VISIBILITY_MATRIX_CACHE = {}
 class Layout:
     """
     A Layout manages the static information about the game board.
+
+    Layouts are immutable once built: the walls and food grids are frozen
+    and game states share one layout instead of copying it. Layouts with the
+    same text are equal and hash alike.
     """
 
     def __init__(self, layoutText):
@@ -33,8 +37,11 @@ class Layout:
         self.agentPositions = []
         self.numGhosts = 0
         self.processLayoutText(layoutText)
-        self.layoutText = layoutText
-        self.totalFood = len(self.food.asList())
+        self.walls.freeze()
+        self.food.freeze()
+        self.layoutText = tuple(layoutText)
+        self.totalFood = self.food.count()
+        self._hash = hash(self.layoutText)
         # self.initializeVisibilityMatrix()
 
     def getNumGhosts(self):
@@ -63,7 +70,7 @@ class Layout:
 
     def isWall(self, pos):
         x, col = pos
-        return self.walls[x][col]
+        return self.walls.get(x, col)
 
     def getRandomLegalPosition(self):
         x = random.choice(range(self.width))
@@ -89,8 +96,19 @@ class Layout:
     def __str__(self):
         return "\n".join(self.layoutText)
 
+    def __eq__(self, other):
+        if not isinstance(other, Layout): return False
+        return self._hash == other._hash and self.layoutText == other.layoutText
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return self._hash
+
     def deepCopy(self):
-        return Layout(self.layoutText[:])
+        # layouts are immutable, so copies can share this one
+        return self
 
     def processLayoutText(self, layoutText):
         """
@@ -115,9 +133,9 @@ class Layout:
 
     def processLayoutChar(self, x, y, layoutChar):
         if layoutChar == '%':
-            self.walls[x][y] = True
+            self.walls.set(x, y, True)
         elif layoutChar == '.':
-            self.food[x][y] = True
+            self.food.set(x, y, True)
         elif layoutChar == 'o':
             self.capsules.append((x, y))
         elif layoutChar == 'P':
@@ -16,11 +16,20 @@
 # Student side autograding was added by Brad Miller, Nick Hay, and
 # Pieter Abbeel (pabbeel@cs.berkeley.edu).
 
+from array import array
+from collections import deque
 from pacman import Directions
 from game import Agent
-import random
+from qTables import makeQTable, saveQTable, loadQTable, MappedQTable, \
+    BoundedQTable, ArrayQTable, ReplayBuffer, SharedQTable, SymmetricQTable, \
+    AbstractQTable, parseSize, ABSENT_ROW
 import util
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 """
 This class represents different rewards that the agent can get
 """
@@ -43,14 +52,6 @@ class Actions:
     LEFT = (-1, 0)
 
 
-def getAllLegalActions(legal):
-    """
-    Get all legal actions
-        @param legal: list of legal directions
-        @return: list of legal actions that can be made"""
-    return [directionToAction[legal_move] for legal_move in legal]
-
-
 # dict to translate Action to Direction class.
 actionToDirection = {
     Actions.UP: Directions.NORTH,
@@ -67,41 +68,64 @@ directionToAction = {
     Directions.WEST: Actions.LEFT,
 }
 
-def convert_grid_to_list(grid):
+# actions in the order of the columns of a q table
+ACTIONS = (Actions.UP, Actions.RIGHT, Actions.DOWN, Actions.LEFT)
+
+# dictionary to translate Direction class to the index of the action.
+directionToIndex = dict((direction, ACTIONS.index(action))
+                        for direction, action in directionToAction.items())
+
+
+def getLegalActionIndices(legal):
     """
-    Converts the location of elements in grid to list
+    Get the indices of all legal actions
+        @param legal: list of legal directions
+        @return: list of indices of legal actions that can be made"""
+    return [directionToIndex[legal_move] for legal_move in legal
+            if legal_move != Directions.STOP]
+
+
+# legal action indices of every bitmask of legal actions
+LEGAL_ACTIONS_OF_MASK = [[action for action in range(len(ACTIONS))
+                          if mask >> action & 1]
+                         for mask in range(1 << len(ACTIONS))]
 
-    @param grid: grid of elements to be converted
-    @return: list with positions of the element in grid
+
+def legal_actions_mask(legal):
     """
-    converted_list = []
+    Converts legal action indices to a bitmask
 
-    for i in range(grid.width):
-        for j in range(grid.height):
-            if grid[i][j]:
-                converted_list.append((i, j))
-    return converted_list
+    @param legal: legal action indices
+    @return: bitmask with the bit of every legal action set"""
+    mask = 0
+    for action in legal:
+        mask |= 1 << action
+    return mask
 
 
-class QState:
+class QState(object):
     """
     Represents state Q learning algorithm.
-    Each QState object contains information of Pacman position, ghosts positions
-    and food position.
+    Each QState object contains the cell index of the Pacman, the cell indices
+    of the ghosts and a bitmask with a bit set for every cell with food.
+    The hash code is computed once in the constructor, as QState objects are
+    looked up in the dictionary of q values several times on every move.
     """
 
+    __slots__ = ('pacman_cell', 'ghost_cells', 'food', '_hash')
 
-    def __init__(self, pacman_pos, ghosts_pos, food_pos):
+    def __init__(self, pacman_cell, ghost_cells, food):
         """
         Constructor to create QState object
 
-        @param pacman_pos: position of a pacman
-        @param ghosts_pos: list of ghosts position
-        @param food_pos: list of food position
+        @param pacman_cell: cell index of a pacman
+        @param ghost_cells: tuple of ghosts cell indices
+        @param food: bitmask of cells with food
         """
-        self.pacman_pos = pacman_pos
-        self.ghosts_pos = ghosts_pos
-        self.food_pos = food_pos
+        self.pacman_cell = pacman_cell
+        self.ghost_cells = ghost_cells
+        self.food = food
+        self._hash = hash((pacman_cell, ghost_cells, food))
 
     def __eq__(self, otherGameStateData):
         """
@@ -111,10 +135,14 @@ class QState:
 
         @return: bool indicating if two objects are equal
         """
-        return self.pacman_pos == otherGameStateData.pacman_pos \
-               and self.ghosts_pos == otherGameStateData.ghosts_pos \
-               and self.food_pos == otherGameStateData.food_pos
+        return self._hash == otherGameStateData._hash \
+               and self.pacman_cell == otherGameStateData.pacman_cell \
+               and self.ghost_cells == otherGameStateData.ghost_cells \
+               and (self.food is otherGameStateData.food
+                    or self.food == otherGameStateData.food)
 
+    def __ne__(self, otherGameStateData):
+        return not self == otherGameStateData
 
     def __hash__(self):
         """
@@ -122,7 +150,10 @@ class QState:
 
         @return: hash code of the object instance
         """
-        return hash((self.pacman_pos, self.ghosts_pos, self.food_pos))
+        return self._hash
+
+    def __reduce__(self):
+        return QState, (self.pacman_cell, self.ghost_cells, self.food)
 
 
 def possible_moves(pos):
@@ -142,212 +173,725 @@ def possible_moves(pos):
     }
 
 
-def search_pos_within_limit(pacman_pos, single_obj_pos, limit, walls_pos,
-                            is_obj_found):
+# cache of LayoutDistances objects keyed by the walls of a layout, so that
+# every agent playing the same layout shares a single distance table
+LAYOUT_DISTANCES_CACHE = {}
+
+
+class LayoutDistances:
     """
-    Recursive search of the object and returns True
-     if the object may be reached within the limit or False otherwise
+    All-pairs shortest path distances between the free cells of a layout.
+    The table is built once with a breadth first search from every cell, so
+    checking whether an object can be reached within a number of moves is
+    a single dictionary lookup.
 
-    @param pacman_pos: pacman position
-    @param single_obj_pos: position of an object that is searched
-    @param limit: number of actions that the Pacman needs to make
-     in order to find the object
-    @param walls_pos: list of walls
-    @param is_obj_found: bool indicating if the object was found within the
-    limit, initially set False
+    Cells are identified by the index x * height + y, which is also the bit
+    used for the cell in the food bitmask of a QState.
+    """
 
-    @return: bool indicating if the object can be reached within the limit
+    def __init__(self, walls):
+        """
+        Constructor to create LayoutDistances object
+
+        @param walls: grid of walls of the layout
+        """
+        self.width = walls.width
+        self.height = walls.height
+        self.cells = [self.cell_index((x, y))
+                      for x in range(walls.width)
+                      for y in range(walls.height)
+                      if not walls[x][y]]
+
+        # free neighbours of every free cell
+        free_cells = set(self.cells)
+        self.neighbours = {}
+        for cell in self.cells:
+            self.neighbours[cell] = [next_cell for next_cell
+                                     in [self.cell_index(next_pos)
+                                         for next_pos in possible_moves(
+                                             self.position(cell)).keys()]
+                                     if next_cell in free_cells]
+
+        # dictionary of cell to dictionary of reachable cells and distances
+        self.distances = {}
+        for cell in self.cells:
+            self.distances[cell] = self.breadth_first_search(cell)
+
+        # cache of bitmasks of cells within a limit, keyed by (cell, limit)
+        self.within_masks = {}
+
+        # cache of reachable cells sorted by their distance, keyed by cell
+        self.cells_by_distance = {}
+
+    def cell_index(self, pos):
+        """
+        Gets the index of the cell at the given position
+
+        @param pos: position as two elements tuple
+
+        @return: cell index
+        """
+        return int(pos[0]) * self.height + int(pos[1])
+
+    def position(self, cell):
+        """
+        Gets the position of the cell with the given index
+
+        @param cell: cell index
+
+        @return: position as two elements tuple
+        """
+        return cell // self.height, cell % self.height
+
+    def breadth_first_search(self, source):
+        """
+        Computes distances from the source cell to every reachable cell
+
+        @param source: cell the search starts from
+
+        @return: dictionary of reachable cells and their distances
+        """
+        distances = {source: 0}
+        frontier = [source]
+        distance = 0
+        while frontier:
+            distance += 1
+            next_frontier = []
+            for cell in frontier:
+                for next_cell in self.neighbours[cell]:
+                    if next_cell not in distances:
+                        distances[next_cell] = distance
+                        next_frontier.append(next_cell)
+            frontier = next_frontier
+        return distances
+
+    def distance(self, cell, other_cell):
+        """
+        Gets the length of the shortest path between two cells
+
+        @param cell: first cell index
+        @param other_cell: second cell index
+
+        @return: number of moves needed, or infinity if there is no path
+        """
+        return self.distances.get(cell, {}).get(other_cell, float('inf'))
+
+    def within_mask(self, cell, limit):
+        """
+        Gets a bitmask of all cells that can be reached from the cell within
+        the limit
+
+        @param cell: cell index the pacman is in
+        @param limit: number of actions that the Pacman can make
+
+        @return: bitmask of reachable cells
+        """
+        key = (cell, limit)
+        mask = self.within_masks.get(key)
+        if mask is None:
+            mask = 0
+            for other_cell, distance in self.distances.get(cell, {}).items():
+                if distance <= limit:
+                    mask |= 1 << other_cell
+            self.within_masks[key] = mask
+        return mask
+
+
+    def nearest(self, cell, mask):
+        """
+        Gets the distance to the nearest cell set in the bitmask
+
+        @param cell: cell index the search starts from
+        @param mask: bitmask of cells that are searched for
+
+        @return: number of moves needed, or None if no cell can be reached
+        """
+        by_distance = self.cells_by_distance.get(cell)
+        if by_distance is None:
+            by_distance = sorted((distance, other_cell) for other_cell, distance
+                                 in self.distances.get(cell, {}).items())
+            self.cells_by_distance[cell] = by_distance
+        for distance, other_cell in by_distance:
+            if mask >> other_cell & 1:
+                return distance
+        return None
+
+
+# cache of LayoutSymmetries objects keyed by the walls of a layout
+LAYOUT_SYMMETRIES_CACHE = {}
+
+
+def getLayoutSymmetries(walls):
     """
-    if limit > 0 and not is_obj_found:
-
-        if pacman_pos == single_obj_pos:
-            return True
-
-        for next_pos, action in possible_moves(pacman_pos).items():
-            if next_pos not in walls_pos:
-                if next_pos == single_obj_pos:
-                    return True
-                else:
-                    is_obj_found = is_obj_found or \
-                                   search_pos_within_limit(
-                                       next_pos,
-                                       single_obj_pos,
-                                       limit - 1,
-                                       walls_pos,
-                                       is_obj_found)
-
-        return is_obj_found
-    else:
-        return is_obj_found
+    Gets the shared symmetries of a layout, finding them on first use
 
+    @param walls: grid of walls of the layout
 
-def is_objects_within_range(pacman_pos, obj_pos, walls_pos, limit):
+    @return: LayoutSymmetries object for the layout
     """
-    Helper function to find if a given object, like food or ghost, can be
-    reached within the limit
-    or False otherwise.
+    key = str(walls)
+    if key not in LAYOUT_SYMMETRIES_CACHE:
+        LAYOUT_SYMMETRIES_CACHE[key] = LayoutSymmetries(walls)
+    return LAYOUT_SYMMETRIES_CACHE[key]
 
-    @param pacman_pos: pacman position
-    @param obj_pos: position of an object that is searched
-    @param walls_pos: positions of walls
-    @param limit: number of actions that the Pacman need to make
-     in order to find the object
 
-    @return: bool indicating if the object can be reached within the limit
+def getLayoutDistances(walls):
     """
-    obj_within_limit_distance = filter(
-        lambda single_obj:
-        util.manhattanDistance(pacman_pos, single_obj) <= limit, obj_pos)
+    Gets the shared distance table of a layout, building it on first use
 
-    if obj_within_limit_distance:
-        for single_obj_pos in obj_within_limit_distance:
-            is_obj_detected = search_pos_within_limit(pacman_pos,
-                                                      single_obj_pos,
-                                                      limit,
-                                                      walls_pos,
-                                                      False)
-            if is_obj_detected:
-                return True
+    @param walls: grid of walls of the layout
 
-    return False
+    @return: LayoutDistances object for the layout
+    """
+    key = str(walls)
+    if key not in LAYOUT_DISTANCES_CACHE:
+        LAYOUT_DISTANCES_CACHE[key] = LayoutDistances(walls)
+    return LAYOUT_DISTANCES_CACHE[key]
 
 
-def getReward(pacman_pos, food_pos, ghosts_pos, walls_pos):
+class LayoutSymmetries:
+    """
+    Mirror symmetries of a layout. A layout can be mirrored left to right,
+    top to bottom or both, the last being a rotation by 180 degrees; every
+    mirroring that leaves the walls unchanged is a symmetry of the layout.
+    The identity is always the first symmetry.
     """
-    Gets a reward given the position where the Pacman is.
 
-    @param pacman_pos: pacman position
-    @param food_pos: position of food
-    @param ghosts_pos: positions of ghosts
-    @param walls_pos: positions of walls
+    def __init__(self, walls):
+        """
+        Constructor to create LayoutSymmetries object
 
-    @return: reward value
+        @param walls: grid of walls of the layout
+        """
+        self.width = walls.width
+        self.height = walls.height
+        # (mirror x, mirror y) of every symmetry
+        self.mirrors = [(flip_x, flip_y)
+                        for flip_x, flip_y in ((False, False), (True, False),
+                                               (False, True), (True, True))
+                        if all(walls[x][y] ==
+                               walls[self.width - 1 - x if flip_x else x]
+                                    [self.height - 1 - y if flip_y else y]
+                               for x in range(self.width)
+                               for y in range(self.height))]
+        # mirrored cell index of every cell index, by symmetry
+        self.cell_maps = [[self.mirror_cell(cell, flip_x, flip_y)
+                           for cell in range(self.width * self.height)]
+                          for flip_x, flip_y in self.mirrors]
+        # mirrored action index of every action index, by symmetry
+        self.action_maps = [[ACTIONS.index((-dx if flip_x else dx,
+                                            -dy if flip_y else dy))
+                             for dx, dy in ACTIONS]
+                            for flip_x, flip_y in self.mirrors]
+
+    def __len__(self):
+        return len(self.mirrors)
+
+    def mirror_cell(self, cell, flip_x, flip_y):
+        """
+        Mirrors a cell index
+
+        @param cell: cell index
+        @param flip_x: mirror left to right
+        @param flip_y: mirror top to bottom
+
+        @return: mirrored cell index
+        """
+        x, y = divmod(cell, self.height)
+        if flip_x:
+            x = self.width - 1 - x
+        if flip_y:
+            y = self.height - 1 - y
+        return x * self.height + y
+
+    def mirror_ghost_cell(self, symmetry, cell):
+        """
+        Mirrors a ghost cell index, which is negative for a ghost between
+        two cells, see QStateEncoder.ghost_cells
+
+        @param symmetry: index of the symmetry
+        @param cell: ghost cell index
+
+        @return: mirrored ghost cell index
+        """
+        if cell >= 0:
+            return self.cell_maps[symmetry][cell]
+        flip_x, flip_y = self.mirrors[symmetry]
+        x, y = divmod(-1 - cell, 2 * self.height)
+        if flip_x:
+            x = 2 * self.width - 2 - x
+        if flip_y:
+            y = 2 * self.height - 2 - y
+        return -1 - (x * 2 * self.height + y)
+
+    def mirror_mask(self, symmetry, mask):
+        """
+        Mirrors a bitmask of cells
+
+        @param symmetry: index of the symmetry
+        @param mask: bitmask of cells
+
+        @return: mirrored bitmask
+        """
+        cell_map = self.cell_maps[symmetry]
+        mirrored = 0
+        while mask:
+            low = mask & -mask
+            mirrored |= 1 << cell_map[low.bit_length() - 1]
+            mask ^= low
+        return mirrored
+
+
+class QStateEncoder:
     """
-    if pacman_pos in ghosts_pos:
-        return Reward.GAME_OVER
-    elif pacman_pos in food_pos:
-        return Reward.FOOD
-    elif is_objects_within_range(pacman_pos, food_pos, walls_pos, 1):
-        return Reward.FOOD_NEAR
-    else:
-        return Reward.DEFAULT
+    Encodes the positions of a game state on one layout into QState objects.
+    Identical food bitmasks are interned, so that all QState objects with the
+    same food share a single int instead of each holding its own copy.
+    """
+
+    def __init__(self, distances, symmetries=None):
+        """
+        Constructor to create QStateEncoder object
+
+        @param distances: LayoutDistances of the layout
+        @param symmetries: LayoutSymmetries of the layout, if states are to
+         be mapped to canonical states
+        """
+        self.distances = distances
+        self.height = distances.height
+        # dictionary used to intern food bitmasks
+        self.food_sets = {}
+        # change of the cell index after an action is taken, by action index
+        self.action_offsets = [dx * self.height + dy for dx, dy in ACTIONS]
+        self.symmetries = symmetries
+        # dictionary of interned food bitmasks and their mirrored bitmasks,
+        # by symmetry
+        self.mirrored_food = {}
+        # dictionary of interned food bitmasks and their number of pellets
+        self.food_counts = {}
+
+    def cell_index(self, pos):
+        """
+        Gets the index of the cell at the given position
+
+        @param pos: position as two elements tuple
+
+        @return: cell index
+        """
+        return self.distances.cell_index(pos)
+
+    def ghost_cells(self, ghosts_pos):
+        """
+        Gets the cell indices of the ghosts. Scared ghosts move at half speed
+        and may be between two cells; such positions are numbered on a grid
+        with half the spacing and stored as negative numbers, so that they
+        never match the cell of the Pacman.
+
+        @param ghosts_pos: list of ghosts position
+
+        @return: tuple of ghosts cell indices
+        """
+        cells = []
+        for x, y in ghosts_pos:
+            if x == int(x) and y == int(y):
+                cells.append(int(x) * self.height + int(y))
+            else:
+                cells.append(-1 - (int(2 * x) * 2 * self.height + int(2 * y)))
+        return tuple(cells)
+
+    def food_mask(self, food):
+        """
+        Converts a grid of food into an interned bitmask. The bits of a grid
+        are numbered like the cells, so they are the bitmask
+
+        @param food: grid of food
+
+        @return: bitmask of cells with food
+        """
+        return self.intern_food(food.bits)
+
+    def intern_food(self, mask):
+        """
+        Gets the shared instance of the food bitmask
+
+        @param mask: bitmask of cells with food
+
+        @return: interned bitmask equal to the given one
+        """
+        return self.food_sets.setdefault(mask, mask)
+
+    def eat_food(self, food, pacman_cell):
+        """
+        Removes the food in a cell from a food bitmask. The mirrored
+        bitmasks of the new food are derived from those of the old food
+
+        @param food: interned bitmask of cells with food
+        @param pacman_cell: cell index of the eaten food
+
+        @return: interned bitmask without the eaten food
+        """
+        eaten = self.intern_food(food & ~(1 << pacman_cell))
+        if self.symmetries is not None and food in self.mirrored_food and \
+                eaten not in self.mirrored_food:
+            self.mirrored_food[eaten] = [
+                mirrored & ~(1 << cell_map[pacman_cell])
+                for mirrored, cell_map in zip(self.mirrored_food[food],
+                                              self.symmetries.cell_maps)]
+        return eaten
+
+    def mirror_food(self, food):
+        """
+        Gets the mirrored bitmasks of a food bitmask
+
+        @param food: interned bitmask of cells with food
 
+        @return: list of mirrored bitmasks, by symmetry
+        """
+        mirrored = self.mirrored_food.get(food)
+        if mirrored is None:
+            mirrored = [self.symmetries.mirror_mask(symmetry, food)
+                        for symmetry in range(len(self.symmetries))]
+            self.mirrored_food[food] = mirrored
+        return mirrored
+
+    def food_count(self, food):
+        """
+        Gets the number of food pellets of a food bitmask
+
+        @param food: interned bitmask of cells with food
+
+        @return: number of cells with food
+        """
+        count = self.food_counts.get(food)
+        if count is None:
+            count = bin(food).count('1')
+            self.food_counts[food] = count
+        return count
+
+    def prune(self, foods):
+        """
+        Drops the interned food bitmasks that are not kept, together with
+        their mirrored bitmasks and food counts. Dropping a bitmask that is
+        still referenced only costs its sharing with equal bitmasks interned
+        later.
+
+        @param foods: set of food bitmasks to keep
+        """
+        self.food_sets = dict((food, food) for food in self.food_sets
+                              if food in foods)
+        self.mirrored_food = dict(item for item in
+                                  self.mirrored_food.iteritems()
+                                  if item[0] in foods)
+        self.food_counts = dict(item for item in self.food_counts.iteritems()
+                                if item[0] in foods)
+
+    def canonical(self, q_state):
+        """
+        Maps a q state to the smallest of its mirrored q states, so that
+        all symmetric q states share one canonical q state
 
-def getQValue(action, state, stats_acts_q_val):
+        @param q_state: q state
+
+        @return: canonical q state and the list of canonical action indices
+         by action index
+        """
+        symmetries = self.symmetries
+        best, best_symmetry = q_state, 0
+        best_key = (q_state.pacman_cell, q_state.ghost_cells, q_state.food)
+        for symmetry in range(1, len(symmetries)):
+            pacman_cell = symmetries.cell_maps[symmetry][q_state.pacman_cell]
+            if pacman_cell > best_key[0]:
+                continue
+            key = (pacman_cell,
+                   tuple(symmetries.mirror_ghost_cell(symmetry, cell)
+                         for cell in q_state.ghost_cells),
+                   self.mirror_food(q_state.food)[symmetry])
+            if key < best_key:
+                best_key, best_symmetry = key, symmetry
+        if best_symmetry:
+            best = QState(best_key[0], best_key[1],
+                          self.intern_food(best_key[2]))
+        return best, symmetries.action_maps[best_symmetry]
+
+    def next_cell(self, pacman_cell, action):
+        """
+        Get the next cell of a Pacman after given action is performed
+
+        @param pacman_cell: pacman cell index
+        @param action: index of the action pacman is making
+
+        @return: cell index of the Pacman after the action is taken
+        """
+        return pacman_cell + self.action_offsets[action]
+
+
+class FoodCountAbstraction:
+    """
+    State abstraction keeping the cells of the Pacman and the ghosts but only
+    the number of food pellets left, in buckets of foodBucket pellets
     """
-    Gets the q value for a given state in a states actions q value
-     dictionary. If a given state or action is absent in the dictionary,
-      then default q value of 0 is returned.
 
-    @param state: q state based on that the q value is retrieved
-    @param action: action based on that the q value is retrieved
-    @param stats_acts_q_val: dictionary of q states, actions and q values
+    def __init__(self, encoder, foodBucket=5, **options):
+        """
+        Constructor to create FoodCountAbstraction object
 
-    @return: q value
+        @param encoder: QStateEncoder of the layout
+        @param foodBucket: number of food pellets counted in one bucket
+        """
+        self.encoder = encoder
+        self.bucket = int(foodBucket)
+
+    def __call__(self, q_state):
+        return QState(q_state.pacman_cell, q_state.ghost_cells,
+                      self.encoder.food_count(q_state.food) // self.bucket)
+
+    @staticmethod
+    def keyShape(num_ghosts, food_bytes):
+        """
+        Gets the shape of the keys on a layout
+
+        @param num_ghosts: number of ghosts of the q states
+        @param food_bytes: number of bytes of the food bitmask of the q states
+
+        @return: number of ghost cells and of food bytes of the keys
+        """
+        return num_ghosts, food_bytes
+
+
+class LocalAbstraction:
+    """
+    State abstraction keeping the cell of the Pacman, the offset of the
+    nearest ghost if it is within ghostRadius cells on both axes and the
+    first action on a shortest path to the nearest food. The key is a QState
+    with the ghost offset as its only ghost cell, -1 for no ghost near, and
+    the action index as its food, len(ACTIONS) if no food can be reached.
     """
-    actions_q_val = stats_acts_q_val.get(state, 0)
-    if actions_q_val is not 0:
-        return actions_q_val.get(action, 0)
-    else:
-        return actions_q_val
 
+    # number of keys cached before the cache is cleared
+    CACHE_SIZE = 4096
 
-def next_position(pacman_pos, action):
+    def __init__(self, encoder, ghostRadius=2, **options):
+        """
+        Constructor to create LocalAbstraction object
+
+        @param encoder: QStateEncoder of the layout
+        @param ghostRadius: largest offset on each axis of a ghost that is
+         kept
+        """
+        self.encoder = encoder
+        self.radius = int(ghostRadius)
+        self.keys = {}
+
+    def __call__(self, q_state):
+        key = self.keys.get(q_state)
+        if key is None:
+            if len(self.keys) >= self.CACHE_SIZE:
+                self.keys.clear()
+            key = QState(q_state.pacman_cell,
+                         (self.ghost_offset(q_state),),
+                         self.food_direction(q_state))
+            self.keys[q_state] = key
+        return key
+
+    @staticmethod
+    def keyShape(num_ghosts, food_bytes):
+        """
+        Gets the shape of the keys on a layout
+
+        @param num_ghosts: number of ghosts of the q states
+        @param food_bytes: number of bytes of the food bitmask of the q states
+
+        @return: number of ghost cells and of food bytes of the keys
+        """
+        return 1, 1
+
+    def ghost_offset(self, q_state):
+        """
+        Gets the offset of the nearest ghost
+
+        @param q_state: q state
+
+        @return: number of the offset, or -1 if no ghost is near
+        """
+        height = self.encoder.height
+        x, y = divmod(q_state.pacman_cell, height)
+        nearest = None
+        for cell in q_state.ghost_cells:
+            if cell >= 0:
+                ghost_x, ghost_y = divmod(cell, height)
+            else:
+                ghost_x, ghost_y = divmod(-1 - cell, 2 * height)
+                ghost_x, ghost_y = ghost_x / 2.0, ghost_y / 2.0
+            dx, dy = int(round(ghost_x - x)), int(round(ghost_y - y))
+            if nearest is None or abs(dx) + abs(dy) < \
+                    abs(nearest[0]) + abs(nearest[1]):
+                nearest = dx, dy
+        if nearest is None or abs(nearest[0]) > self.radius or \
+                abs(nearest[1]) > self.radius:
+            return -1
+        return (nearest[0] + self.radius) * (2 * self.radius + 1) + \
+            nearest[1] + self.radius
+
+    def food_direction(self, q_state):
+        """
+        Gets the first action on a shortest path to the nearest food
+
+        @param q_state: q state
+
+        @return: action index, or len(ACTIONS) if no food can be reached
+        """
+        distances = self.encoder.distances
+        neighbours = distances.neighbours.get(q_state.pacman_cell, ())
+        best, best_distance = len(ACTIONS), None
+        for action in range(len(ACTIONS)):
+            next_cell = self.encoder.next_cell(q_state.pacman_cell, action)
+            if next_cell not in neighbours:
+                continue
+            distance = distances.nearest(next_cell, q_state.food)
+            if distance is not None and (best_distance is None or
+                                         distance < best_distance):
+                best, best_distance = action, distance
+        return best
+
+
+# state abstractions selectable with the abstraction argument of
+# QLearnAgent, besides 'exact' which keys the q table on the QState itself
+STATE_ABSTRACTIONS = {
+    'foodCount': FoodCountAbstraction,
+    'local': LocalAbstraction,
+}
+
+
+def is_objects_within_range(pacman_cell, obj_mask, distances, limit):
     """
-    Get the next position of a Pacman after given action is performed
+    Helper function to find if a given object, like food or ghost, can be
+    reached within the limit
+    or False otherwise.
 
-    @param pacman_pos: pacman position
-    @param action: action pacman is making
+    @param pacman_cell: pacman cell index
+    @param obj_mask: bitmask of cells with the object that is searched
+    @param distances: LayoutDistances of the layout
+    @param limit: number of actions that the Pacman need to make
+     in order to find the object
 
-    @return: position of the Pacman after the action is taken
+    @return: bool indicating if the object can be reached within the limit
     """
-    return tuple(map(sum, zip(pacman_pos, action)))
+    return obj_mask & distances.within_mask(pacman_cell, limit) != 0
 
 
-def max_next_q_values(pacman_pos, ghosts_pos, food_pos, stats_acts_q_val,
-                      legal):
+def getReward(pacman_cell, food, ghost_cells, distances):
     """
-    Gets a maximum of the q values of all possible next q states
+    Gets a reward given the cell where the Pacman is.
 
-    @param pacman_pos: pacman position
-    @param ghosts_pos: positions of ghosts
-    @param food_pos: position of food
-    @param stats_acts_q_val: dictionary of q states, actions and q values
-    @param legal: legal actions
+    @param pacman_cell: pacman cell index
+    @param food: bitmask of cells with food
+    @param ghost_cells: cell indices of ghosts
+    @param distances: LayoutDistances of the layout
 
-    @return: position of the Pacman after the action is taken
+    @return: reward value
     """
-    next_q_val = []
+    if pacman_cell in ghost_cells:
+        return Reward.GAME_OVER
+    elif food >> pacman_cell & 1:
+        return Reward.FOOD
+    elif is_objects_within_range(pacman_cell, food, distances, 1):
+        return Reward.FOOD_NEAR
+    else:
+        return Reward.DEFAULT
 
-    for action in getAllLegalActions(legal):
-        next_q_state = QState(next_position(pacman_pos, action),
-                              ghosts_pos, food_pos)
-        next_q_val.append(getQValue(action, next_q_state, stats_acts_q_val))
 
-    return max(next_q_val) if next_q_val else 0
+def max_next_q_values(q_state, stats_acts_q_val, legal):
+    """
+    Gets a maximum of the q values of all actions possible in the q state
 
+    @param q_state: q state the Pacman is in
+    @param stats_acts_q_val: q table of q states, actions and q values
+    @param legal: legal action indices
 
-def best_next_action(pacman_pos, ghosts_pos, food_pos, stats_acts_q_val,
-                     legal):
+    @return: maximum q value, or 0 if there are no legal actions
     """
-    Gets the best action that can be taken in a given situation
-        based on q values in the dictionary of q states, actions and q values.
+    return stats_acts_q_val.maxQValue(q_state, legal)
 
-    @param pacman_pos: pacman position
-    @param ghosts_pos: positions of ghosts
-    @param food_pos: position of food
-    @param stats_acts_q_val: dictionary of q states, actions and q values
-    @param legal: legal actions
 
-    @return: best action to be taken
+def best_next_action(q_state, stats_acts_q_val, legal):
     """
-    best_q_val = float('-inf')
-    best_action = None
+    Gets the best action that can be taken in a given situation
+        based on q values in the q table of q states, actions and q values.
 
-    for action in getAllLegalActions(legal):
-        next_q_state = QState(next_position(pacman_pos, action),
-                              ghosts_pos, food_pos)
-        next_q_val = getQValue(action, next_q_state, stats_acts_q_val)
-        if next_q_val >= best_q_val:
-            best_q_val = next_q_val
-            best_action = action
+    @param q_state: q state the Pacman is in
+    @param stats_acts_q_val: q table of q states, actions and q values
+    @param legal: legal action indices
 
-    return best_action
+    @return: index of the best action to be taken
+    """
+    return stats_acts_q_val.bestAction(q_state, legal)
 
 
-def e_greedy_action(legal, pacman_pos, ghosts_pos, food_pos, epsilon,
-                    stats_acts_q_val):
+def e_greedy_action(legal, q_state, epsilon, stats_acts_q_val):
     """
     Gets action based on an e-greedy method
 
-    @param pacman_pos: pacman position
-    @param ghosts_pos: positions of ghosts
-    @param food_pos: position of food
+    @param legal: legal action indices
+    @param q_state: q state the Pacman is in
     @param epsilon: epsilon parameter in e-greedy method
-    @param stats_acts_q_val: dictionary of q states, actions and q values
+    @param stats_acts_q_val: q table of q states, actions and q values
 
-    @return: action to be performed
+    @return: index of the action to be performed
     """
-    if random.uniform(0, 1.0) > epsilon:
-        return best_next_action(pacman_pos, ghosts_pos, food_pos,
-                                stats_acts_q_val, legal)
+    if util.rng.random() > epsilon:
+        return best_next_action(q_state, stats_acts_q_val, legal)
     else:
-        random_action = random.choice(legal)
-        return directionToAction[random_action]
+        return util.rng.choice(legal)
 
 
-class QLearnAgent(Agent):
+# names of the features of ApproximateQAgent, in the order of its weights
+FEATURES = ('bias', 'ghosts-1-step-away', 'eats-food', 'closest-food')
+
+
+def get_features(pacman_cell, food, ghost_cells, encoder, legal):
+    """
+    Gets the features of every legal action, computed from the cell the
+    Pacman moves into. All features are scaled down by 10 to keep the
+    updates of the weights small.
+
+    @param pacman_cell: pacman cell index
+    @param food: bitmask of cells with food
+    @param ghost_cells: cell indices of ghosts
+    @param encoder: QStateEncoder of the layout
+    @param legal: legal action indices
+
+    @return: array with a row of features for every legal action
+    """
+    distances = encoder.distances
+    size = float(distances.width * distances.height)
+    features = numpy.zeros((len(legal), len(FEATURES)))
+    features[:, 0] = 1.0
+    for row, action in enumerate(legal):
+        next_cell = encoder.next_cell(pacman_cell, action)
+        ghosts = sum(1 for ghost_cell in ghost_cells
+                     if ghost_cell >= 0
+                     and distances.distance(next_cell, ghost_cell) <= 1)
+        features[row, 1] = ghosts
+        if not ghosts and food >> next_cell & 1:
+            features[row, 2] = 1.0
+        closest = distances.nearest(next_cell, food)
+        if closest is not None:
+            features[row, 3] = closest / size
+    return features / 10.0
+
+
+class EncodedStateAgent(Agent):
+    """
+    Base of the learning agents: holds the learning parameters and the
+    count of episodes, and encodes game states for the current layout,
+    keeping a bitmask of the food left in the current episode.
+    """
 
-    # Constructor, called when we start running the game
     def __init__(self, alpha=0.2, epsilon=0.05, gamma=0.8, numTraining=10):
         # alpha       - learning rate
         # epsilon     - exploration rate
         # gamma       - discount factor
         # numTraining - number of training episodes
-        #
-        # These values are either passed from the command line or are
-        # set to the default values above. We need to create and set
-        # variables for them
         self.alpha = float(alpha)
         self.epsilon = float(epsilon)
         self.gamma = float(gamma)
@@ -355,18 +899,11 @@ class QLearnAgent(Agent):
         # Count the number of games we have played
         self.episodesSoFar = 0
 
-        # dictionary representing dictionary of states, actions and related Q
-        # value
-        self.stats_acts_q_val = {}
+        # encoder of game states into q states for the current layout
+        self.encoder = None
 
-        # previous action
-        self.prev_action = None
-
-        # previous q state
-        self.prev_q_state = None
-
-        # position of walls
-        self.walls_pos = None
+        # bitmask of the food left in the current episode
+        self.food = None
 
     # Accessor functions for the variable episodesSoFars controlling learning
     def incrementEpisodesSoFar(self):
@@ -394,86 +931,931 @@ class QLearnAgent(Agent):
     def getMaxAttempts(self):
         return self.maxAttempts
 
+    # registerInitialState
+    #
+    # Called by the game before the first move of every episode. The food
+    # grid is only scanned here, getAction keeps the bitmask up to date
+    def registerInitialState(self, state):
+        distances = getLayoutDistances(state.getWalls())
+        if self.encoder is None or self.encoder.distances is not distances:
+            self.startLayout(distances, state.getWalls())
+        self.food = self.encoder.food_mask(state.getFood())
+
+    def startLayout(self, distances, walls):
+        """
+        Creates the encoder of a layout the agent plays on for the first time
+
+        @param distances: LayoutDistances of the layout
+        @param walls: grid of walls of the layout
+        """
+        self.encoder = QStateEncoder(distances)
+
+    def updateFood(self, pacman_cell):
+        """
+        Removes the food eaten by the Pacman from the food bitmask. Only the
+        Pacman eats food, and it does so by moving into the cell, so at most
+        the pellet in its current cell changed since the previous move.
+
+        @param pacman_cell: pacman cell index
+        """
+        if self.food >> pacman_cell & 1:
+            self.food = self.encoder.eat_food(self.food, pacman_cell)
+
+
+class QLearnAgent(EncodedStateAgent):
+
+    # Constructor, called when we start running the game
+    def __init__(self, alpha=0.2, epsilon=0.05, gamma=0.8, numTraining=10,
+                 qTable='dict', saveFile=None, saveEvery=0, loadFile=None,
+                 readOnly=False, maxStates=None, maxBytes=None,
+                 eviction='lru', replaySize=0, replayBatch=128,
+                 replayEvery=1, traceDecay=0, traceCutoff=0.01,
+                 planningSteps=0, planningThreshold=0.01,
+                 episodeReplay=False, convergeEpisodes=0,
+                 convergeTdError=1.0, convergeDiscovery=0.01,
+                 convergeWinRate=0.05, symmetry=False, abstraction='exact',
+                 foodBucket=5, ghostRadius=2, compilePolicy=False):
+        # alpha       - learning rate
+        # epsilon     - exploration rate
+        # gamma       - discount factor
+        # numTraining - number of training episodes
+        # qTable      - storage backend of the q values, 'dict' or 'array'
+        # saveFile    - checkpoint file the q table is written to when
+        #               training is done
+        # saveEvery   - also write the checkpoint every saveEvery episodes
+        # loadFile    - checkpoint file the q table is read from
+        # readOnly    - memory-map loadFile and play without learning
+        # maxStates   - maximum number of states kept in the q table
+        # maxBytes    - maximum memory of the q table, e.g. 512M
+        # eviction    - policy used to evict states, 'lru' or 'lfu'
+        # replaySize  - number of transitions kept for experience replay,
+        #               0 disables replay; needs qTable=array
+        # replayBatch - number of transitions replayed in one batch
+        # replayEvery - number of moves between replayed batches
+        # traceDecay  - lambda of Watkins Q(lambda), 0 disables eligibility
+        #               traces
+        # traceCutoff - eligibility traces below this value are dropped
+        # planningSteps - number of backups of the learned model planned
+        #               after every move, 0 disables planning
+        # planningThreshold - smallest temporal difference of a backup that
+        #               is planned
+        # episodeReplay - replay the updates of the whole episode backwards
+        #               when it ends
+        # convergeEpisodes - stop training early once the statistics of
+        #               this many episodes are stable, 0 disables it
+        # convergeTdError - largest average temporal difference of a move
+        # convergeDiscovery - largest number of new states per move
+        # convergeWinRate - largest change of the win rate between the
+        #               last two windows of convergeEpisodes episodes
+        # symmetry    - store the q values of states that are mirror images
+        #               of each other on a symmetric layout only once
+        # abstraction - key of the q table, 'exact' for the QState itself,
+        #               'foodCount' or 'local', see STATE_ABSTRACTIONS
+        # foodBucket  - number of food pellets in one bucket of foodCount
+        # ghostRadius - largest ghost offset kept by local
+        # compilePolicy - once training is done, play from a compiled map
+        #               of states to their best actions without learning
+        #
+        # These values are either passed from the command line or are
+        # set to the default values above. We need to create and set
+        # variables for them
+        EncodedStateAgent.__init__(self, alpha, epsilon, gamma, numTraining)
+
+        self.saveFile = saveFile
+        self.saveEvery = int(saveEvery)
+        self.readOnly = bool(int(readOnly))
+
+        # q table of states, actions and related Q value. The q values of a
+        # state are the values of the actions taken from it
+        if self.readOnly:
+            if loadFile is None:
+                raise Exception('readOnly requires a loadFile checkpoint')
+            self.stats_acts_q_val = MappedQTable(loadFile)
+            self.setAlpha(0)
+            self.setEpsilon(0)
+        else:
+            self.stats_acts_q_val = makeQTable(qTable)
+            if maxStates is not None or maxBytes is not None:
+                self.stats_acts_q_val = BoundedQTable(
+                    self.stats_acts_q_val,
+                    maxStates=None if maxStates is None else int(maxStates),
+                    maxBytes=None if maxBytes is None else parseSize(maxBytes),
+                    policy=eviction, onEvict=self.pruneEncoder)
+            if loadFile is not None:
+                loadQTable(loadFile, self.stats_acts_q_val, QState)
+        self.symmetry = bool(int(symmetry))
+        if self.symmetry:
+            self.stats_acts_q_val = SymmetricQTable(self.stats_acts_q_val,
+                                                    self.canonicalState)
+
+        # state abstraction of the current layout, created together with
+        # the encoder
+        if abstraction != 'exact' and abstraction not in STATE_ABSTRACTIONS:
+            raise Exception('Unknown state abstraction "%s", expected exact '
+                            'or one of %s' % (abstraction, ', '.join(
+                                sorted(STATE_ABSTRACTIONS))))
+        if abstraction != 'exact' and self.symmetry:
+            raise Exception('symmetry only works with the exact state '
+                            'abstraction')
+        self.abstraction = abstraction
+        self.abstraction_options = {'foodBucket': foodBucket,
+                                    'ghostRadius': ghostRadius}
+        self.abstract_state = None
+        if self.abstraction != 'exact':
+            self.stats_acts_q_val = AbstractQTable(self.stats_acts_q_val,
+                                                   self.abstractState)
+
+        # number of updates of every state and action, counted only while
+        # training in parallel
+        self.visit_counts = None
+        # number of updates made by experience replay, by (row id, action)
+        # pair of the array q table, counted only while training in parallel
+        self.replay_counts = None
+
+        # update q values with addQValue, which adds the change of a q value
+        # under a lock, set while training with a locked shared q table
+        self.locked_updates = False
+
+        # buffer of transitions for experience replay
+        self.replay = None
+        self.replayBatch = int(replayBatch)
+        self.replayEvery = int(replayEvery)
+        self.replaySteps = 0
+        if int(replaySize) > 0 and not self.readOnly:
+            if not isinstance(self.stats_acts_q_val, ArrayQTable):
+                raise Exception('Experience replay needs an unbounded '
+                                'qTable=array q table')
+            self.replay = ReplayBuffer(replaySize)
+
+        # eligibility traces of recently taken actions, keyed by (state,
+        # action). Traces decay by gamma * traceDecay on every move and are
+        # dropped below traceCutoff, so only a few recent actions are kept
+        self.traces = None
+        self.traceDecay = float(traceDecay)
+        self.traceCutoff = float(traceCutoff)
+        if self.traceDecay > 0 and not self.readOnly:
+            self.traces = {}
+
+        # model of the outcomes of the actions taken, keyed by (state,
+        # action) with (reward, state observed next, legal actions) values,
+        # and the (state, action) pairs observed to lead to every state.
+        # Backups are planned by prioritized sweeping, largest temporal
+        # difference first
+        self.model = None
+        self.predecessors = None
+        self.planningSteps = int(planningSteps)
+        self.planningThreshold = float(planningThreshold)
+        if self.planningSteps > 0 and not self.readOnly:
+            self.model = {}
+            self.predecessors = {}
+            self.planning_queue = util.PriorityQueue()
+            # priority of every queued (state, action) pair
+            self.queued = {}
+
+        # updates of the current episode, replayed backwards by final. The
+        # buffers are allocated once and reused by every episode
+        self.episodeReplay = bool(int(episodeReplay)) and not self.readOnly
+        self.episode_length = 0
+        if self.episodeReplay:
+            self.allocateEpisodeBuffers(1024)
+
+        # statistics of the training episodes used to detect convergence:
+        # moving averages of the temporal difference and of the new states
+        # per move, and the wins of the last two windows of episodes
+        self.convergeEpisodes = int(convergeEpisodes)
+        self.convergeTdError = float(convergeTdError)
+        self.convergeDiscovery = float(convergeDiscovery)
+        self.convergeWinRate = float(convergeWinRate)
+        self.converged = False
+        self.track_convergence = self.convergeEpisodes > 0 and \
+            not self.readOnly
+        if self.track_convergence:
+            self.td_error_average = None
+            self.discovery_average = None
+            self.recent_wins = deque(maxlen=2 * self.convergeEpisodes)
+            self.episode_td_error = 0.0
+            self.episode_updates = 0
+            self.episode_start_states = len(self.stats_acts_q_val)
+
+        # map of q states to their best actions, used instead of the q
+        # table in inference mode, which skips all learning bookkeeping
+        self.compilePolicy = bool(int(compilePolicy))
+        self.inference = self.compilePolicy and self.readOnly
+        self.policy = None
+
+        # previous action
+        self.prev_action = None
+
+        # previous q state
+        self.prev_q_state = None
+
+    def registerInitialState(self, state):
+        if self.abstraction != 'exact' and self.encoder is not None:
+            # the keys of the q table do not hold food bitmasks, so the
+            # bitmasks of earlier episodes are no longer needed
+            self.encoder.prune(())
+        EncodedStateAgent.registerInitialState(self, state)
+        if self.replay is not None:
+            # the batches of a game follow the randomness of the game, so
+            # games played with --seed replay the same transitions
+            self.replay.seed(int(util.rng.random() * (1 << 32)))
+        if self.inference and self.policy is None:
+            self.compileGreedyPolicy()
+
+    def startLayout(self, distances, walls):
+        """
+        Creates the encoder and the state abstraction of a layout the agent
+        plays on for the first time, and drops the compiled policy of the
+        previous layout
+
+        @param distances: LayoutDistances of the layout
+        @param walls: grid of walls of the layout
+        """
+        self.encoder = QStateEncoder(
+            distances, getLayoutSymmetries(walls) if self.symmetry else None)
+        if self.abstraction != 'exact':
+            self.abstract_state = STATE_ABSTRACTIONS[self.abstraction](
+                self.encoder, **self.abstraction_options)
+        self.policy = None
+
+    def pruneEncoder(self, states):
+        """
+        Drops the food bitmasks the encoder keeps for states evicted from
+        the bounded q table, so that the encoder stays within the bound too
+
+        @param states: q states left in the q table
+        """
+        if self.encoder is None:
+            return
+        foods = set([self.food])
+        if self.abstraction == 'exact':
+            foods.update(state.food for state in states)
+        self.encoder.prune(foods)
+
+    def allocateEpisodeBuffers(self, capacity):
+        """
+        Allocates the buffers of the updates of an episode, keeping the
+        updates already stored
+
+        @param capacity: number of updates the buffers can hold
+        """
+        length = self.episode_length
+        states = [None] * capacity
+        next_states = [None] * capacity
+        actions = array('b', [0]) * capacity
+        rewards = array('d', [0.0]) * capacity
+        legal_masks = array('B', [0]) * capacity
+        if length:
+            states[:length] = self.episode_states[:length]
+            next_states[:length] = self.episode_next_states[:length]
+            actions[:length] = self.episode_actions[:length]
+            rewards[:length] = self.episode_rewards[:length]
+            legal_masks[:length] = self.episode_legal_masks[:length]
+        self.episode_states = states
+        self.episode_next_states = next_states
+        self.episode_actions = actions
+        self.episode_rewards = rewards
+        self.episode_legal_masks = legal_masks
+
     # getAction
     #
     # The main method required by the game. Called every time that
     # Pacman is expected to move
     def getAction(self, state):
-        legal = state.getLegalPacmanActions()
-        if Directions.STOP in legal:
-            legal.remove(Directions.STOP)
-
         # collect all information of the current state in the game
-        pacman_pos = state.getPacmanPosition()
-        ghosts_pos = tuple(state.getGhostPositions())
-        food_pos = tuple(convert_grid_to_list(state.getFood()))
-        if not self.walls_pos:
-            self.walls_pos = convert_grid_to_list(state.getWalls())
+        pacman_cell = self.encoder.cell_index(state.getPacmanPosition())
+        self.updateFood(pacman_cell)
+        q_state = QState(pacman_cell,
+                         self.encoder.ghost_cells(state.getGhostPositions()),
+                         self.food)
+
+        if self.inference:
+            action = self.policy.get(q_state)
+            if action is None:
+                action = best_next_action(
+                    q_state, self.stats_acts_q_val,
+                    getLegalActionIndices(state.getLegalPacmanActions()))
+                self.policy[q_state] = action
+            return actionToDirection[ACTIONS[action]]
+
+        legal = getLegalActionIndices(state.getLegalPacmanActions())
 
         # if previous q state exists
-        if self.prev_q_state:
+        if self.prev_q_state is not None and not self.readOnly:
             # update the q states, actions and q value dict
             self.updateStatesActionsQValue(self.prev_action,
                                            self.prev_q_state,
-                                           self.walls_pos,
-                                           legal)
+                                           legal, q_state)
 
         # select action based on e-greedy algorithm
-        action = e_greedy_action(legal, pacman_pos, ghosts_pos, food_pos,
-                                 self.epsilon, self.stats_acts_q_val)
+        action = e_greedy_action(legal, q_state, self.epsilon,
+                                 self.stats_acts_q_val)
+
+        # Watkins Q(lambda) only credits earlier actions for the returns of
+        # the greedy policy, so an exploratory action cuts the traces
+        if self.traces:
+            best_action, best_q_value = self.stats_acts_q_val.maxAction(
+                q_state, legal)
+            if action != best_action and \
+                    self.stats_acts_q_val.getQValue(q_state, action) < \
+                    best_q_value:
+                self.traces.clear()
 
         self.prev_action = action
-        self.prev_q_state = QState(next_position(pacman_pos, action),
-                                   ghosts_pos,
-                                   food_pos)
+        self.prev_q_state = q_state
+
+        return actionToDirection[ACTIONS[action]]
+
 
-        return actionToDirection[action]
+    def compileGreedyPolicy(self):
+        """
+        Compiles the q table into a map of q states to their best actions on
+        the current layout. States of a wrapped q table are keyed by their
+        canonical or abstract keys, so their best actions are only added to
+        the map when the states are first seen
+        """
+        self.policy = {}
+        table = self.stats_acts_q_val
+        if isinstance(table, (SymmetricQTable, AbstractQTable)):
+            return
+        if isinstance(table, MappedQTable):
+            rows = table.rows(QState)
+        else:
+            rows = table.rows()
+        neighbours = self.encoder.distances.neighbours
+        for q_state, _ in rows:
+            legal = [action for action in range(len(ACTIONS))
+                     if self.encoder.next_cell(q_state.pacman_cell, action)
+                     in neighbours.get(q_state.pacman_cell, ())]
+            if legal:
+                self.policy[q_state] = best_next_action(q_state, table, legal)
+
+    def canonicalState(self, q_state):
+        """
+        Maps a q state to its canonical q state on the current layout
 
+        @param q_state: q state
 
-    def updateStatesActionsQValue(self, action, q_state, walls_pos, legal):
+        @return: canonical q state and the list of canonical action indices
+         by action index
         """
-        Updates the dictionary of q states, actions based on Q learning formula
+        return self.encoder.canonical(q_state)
 
-        @param action: previous action
-        @param q_state: previous q state
-        @param legal: legal actions
-        @param walls_pos: list of walls positions
+    def abstractState(self, q_state):
         """
-        if q_state not in self.stats_acts_q_val:
-            self.stats_acts_q_val[q_state] = {}
+        Maps a q state to its key under the state abstraction
 
-        q_value = self.stats_acts_q_val[q_state].get(action, 0)
+        @param q_state: q state
 
-        self.stats_acts_q_val[q_state][action] = \
-            q_value + \
-            self.alpha * \
-            (getReward(q_state.pacman_pos,
-                       q_state.food_pos,
-                       q_state.ghosts_pos,
-                       walls_pos) +
-             self.gamma *
-             max_next_q_values(q_state.pacman_pos,
-                               q_state.ghosts_pos,
-                               q_state.food_pos,
-                               self.stats_acts_q_val,
-                               legal)
-             - q_value)
+        @return: abstract key of the q state
+        """
+        return self.abstract_state(q_state)
+
+    def updateStatesActionsQValue(self, action, q_state, legal,
+                                  observed_q_state=None):
+        """
+        Updates the q table of q states, actions based on Q learning formula
+
+        @param action: previous action index
+        @param q_state: previous q state, in which the action was taken
+        @param legal: legal action indices after the action
+        @param observed_q_state: q state observed after the action, learned
+         by the model of the planner
+        """
+        next_q_state = QState(
+            self.encoder.next_cell(q_state.pacman_cell, action),
+            q_state.ghost_cells,
+            q_state.food)
+
+        q_value = self.stats_acts_q_val.getQValue(q_state, action)
+        reward = getReward(next_q_state.pacman_cell,
+                           next_q_state.food,
+                           next_q_state.ghost_cells,
+                           self.encoder.distances)
+
+        difference = reward + \
+            self.gamma * \
+            max_next_q_values(next_q_state,
+                              self.stats_acts_q_val,
+                              legal) \
+            - q_value
+        if self.track_convergence:
+            self.episode_td_error += abs(difference)
+            self.episode_updates += 1
+        if self.traces is None:
+            self.changeQValue(q_state, action, q_value,
+                              self.alpha * difference)
+        else:
+            self.updateTraces(q_state, action, difference)
+
+        if self.replay is not None and self.alpha > 0:
+            self.replayTransition(q_state, action, reward, next_q_state, legal)
+
+        if self.episodeReplay and self.alpha > 0:
+            self.recordUpdate(q_state, action, reward, next_q_state, legal)
+
+        if self.model is not None and self.alpha > 0 and \
+                observed_q_state is not None:
+            self.updateModel(q_state, action, reward, observed_q_state, legal)
+
+    def changeQValue(self, q_state, action, q_value, change):
+        """
+        Adds a change to the q value of a state and action. While training
+        with a locked shared q table the change is added under the lock, so
+        that changes made by other workers since q_value was read are kept
+
+        @param q_state: q state
+        @param action: action index
+        @param q_value: q value the change was computed from
+        @param change: change of the q value
+        """
+        if self.locked_updates:
+            self.stats_acts_q_val.addQValue(q_state, action, change)
+        else:
+            self.stats_acts_q_val.setQValue(q_state, action, q_value + change)
+        if self.visit_counts is not None:
+            key = (q_state, action)
+            self.visit_counts[key] = self.visit_counts.get(key, 0) + 1
+
+    def updateTraces(self, q_state, action, difference):
+        """
+        Updates the q values of all actions with an eligibility trace by the
+        temporal difference of the latest action, then decays the traces
+
+        @param q_state: q state the latest action was taken in
+        @param action: latest action index
+        @param difference: temporal difference of the latest action
+        """
+        self.traces[(q_state, action)] = 1.0
+        decay = self.gamma * self.traceDecay
+        for key, trace in self.traces.items():
+            traced_state, traced_action = key
+            self.changeQValue(traced_state, traced_action,
+                              self.stats_acts_q_val.getQValue(traced_state,
+                                                              traced_action),
+                              self.alpha * difference * trace)
+            trace *= decay
+            if trace < self.traceCutoff:
+                del self.traces[key]
+            else:
+                self.traces[key] = trace
+
+    def recordUpdate(self, q_state, action, reward, next_q_state, legal):
+        """
+        Stores an update of the current episode for the backward replay
+
+        @param q_state: q state the action was taken in
+        @param action: action index
+        @param reward: reward received for the action
+        @param next_q_state: q state after the action
+        @param legal: legal action indices after the action
+        """
+        i = self.episode_length
+        if i == len(self.episode_states):
+            self.allocateEpisodeBuffers(2 * i)
+        self.episode_states[i] = q_state
+        self.episode_next_states[i] = next_q_state
+        self.episode_actions[i] = action
+        self.episode_rewards[i] = reward
+        self.episode_legal_masks[i] = legal_actions_mask(legal)
+        self.episode_length = i + 1
+
+    def replayEpisode(self):
+        """
+        Repeats the updates of the episode from the last to the first one,
+        so that the reward at the end of the episode reaches every state on
+        the path in one pass. The last update was just made by final and is
+        not repeated
+        """
+        table = self.stats_acts_q_val
+        for i in xrange(self.episode_length - 2, -1, -1):
+            q_state = self.episode_states[i]
+            action = self.episode_actions[i]
+            q_value = table.getQValue(q_state, action)
+            self.changeQValue(
+                q_state, action, q_value,
+                self.alpha *
+                (self.episode_rewards[i] +
+                 self.gamma *
+                 max_next_q_values(
+                     self.episode_next_states[i], table,
+                     LEGAL_ACTIONS_OF_MASK[self.episode_legal_masks[i]])
+                 - q_value))
+        self.episode_length = 0
+
+    def updateModel(self, q_state, action, reward, observed_q_state, legal):
+        """
+        Learns the outcome of an action, queues its backup and those of the
+        actions leading to its state, and plans the queued backups
+
+        @param q_state: q state the action was taken in
+        @param action: action index
+        @param reward: reward received for the action
+        @param observed_q_state: q state observed after the action
+        @param legal: legal action indices after the action
+        """
+        key = (q_state, action)
+        self.model[key] = (reward, observed_q_state, legal)
+        self.predecessors.setdefault(observed_q_state, set()).add(key)
+        self.queueBackup(key)
+        self.queuePredecessors(q_state)
+        self.planBackups()
+
+    def queueBackup(self, key):
+        """
+        Queues the backup of a state and action of the model by its temporal
+        difference, if it is above the threshold
+
+        @param key: (q state, action index) pair of the model
+        """
+        q_state, action = key
+        reward, next_q_state, legal = self.model[key]
+        priority = abs(reward +
+                       self.gamma *
+                       max_next_q_values(next_q_state,
+                                         self.stats_acts_q_val,
+                                         legal)
+                       - self.stats_acts_q_val.getQValue(q_state, action))
+        if priority > self.planningThreshold and \
+                priority > self.queued.get(key, 0):
+            self.queued[key] = priority
+            # PriorityQueue pops the lowest priority first
+            self.planning_queue.push(key, -priority)
+
+    def queuePredecessors(self, q_state):
+        """
+        Queues backups of the actions observed to lead to a state whose q
+        values changed
+
+        @param q_state: q state whose q values changed
+        """
+        for key in self.predecessors.get(q_state, ()):
+            self.queueBackup(key)
+
+    def planBackups(self):
+        """
+        Backs up the q values of up to planningSteps queued actions from the
+        learned model, largest temporal difference first
+        """
+        backups = 0
+        while backups < self.planningSteps and \
+                not self.planning_queue.isEmpty():
+            key = self.planning_queue.pop()
+            if self.queued.pop(key, None) is None:
+                # already backed up from an entry with a higher priority
+                continue
+            q_state, action = key
+            reward, next_q_state, legal = self.model[key]
+            q_value = self.stats_acts_q_val.getQValue(q_state, action)
+            self.changeQValue(
+                q_state, action, q_value,
+                self.alpha *
+                (reward +
+                 self.gamma *
+                 max_next_q_values(next_q_state, self.stats_acts_q_val, legal)
+                 - q_value))
+            self.queuePredecessors(q_state)
+            backups += 1
+
+    def replayTransition(self, q_state, action, reward, next_q_state, legal):
+        """
+        Stores a transition in the replay buffer and replays a batch of
+        stored transitions every replayEvery moves
+
+        @param q_state: q state the action was taken in
+        @param action: action index
+        @param reward: reward received for the action
+        @param next_q_state: q state after the action
+        @param legal: legal action indices after the action
+        """
+        # the next state is predicted and may never be occupied, so it is
+        # not given a row of its own
+        next_row = self.stats_acts_q_val.rowId(next_q_state, False)
+        if next_row is None:
+            next_row = ABSENT_ROW
+        self.replay.add(self.stats_acts_q_val.rowId(q_state), action, reward,
+                        next_row, legal)
+        self.replaySteps += 1
+        if self.replaySteps % self.replayEvery == 0 and \
+                len(self.replay) >= self.replayBatch:
+            rows, actions = self.replay.replay(self.stats_acts_q_val.values,
+                                               self.replayBatch, self.alpha,
+                                               self.gamma)
+            if self.replay_counts is not None:
+                for key in zip(rows.tolist(), actions.tolist()):
+                    self.replay_counts[key] = self.replay_counts.get(key, 0) + 1
 
     # Handle the end of episodes
     #
-    # This is called by the game after a win or a loss.
+    # This is called by the game after a win, a loss or a truncation. A
+    # truncated game is not over for the Pacman, its state still has legal
+    # actions, so the last update bootstraps from their q values
     def final(self, state):
+        if self.inference:
+            self.incrementEpisodesSoFar()
+            return
         # update the q states, actions and q value dict based on the last action
-        self.updateStatesActionsQValue(self.prev_action,
-                                       self.prev_q_state,
-                                       self.walls_pos,
-                                       state.getLegalPacmanActions())
+        if not self.readOnly:
+            q_state = None
+            if self.model is not None:
+                pacman_cell = self.encoder.cell_index(
+                    state.getPacmanPosition())
+                self.updateFood(pacman_cell)
+                q_state = QState(
+                    pacman_cell,
+                    self.encoder.ghost_cells(state.getGhostPositions()),
+                    self.food)
+            self.updateStatesActionsQValue(self.prev_action,
+                                           self.prev_q_state,
+                                           getLegalActionIndices(
+                                               state.getLegalPacmanActions()),
+                                           q_state)
+            if self.traces is not None:
+                self.traces.clear()
+            if self.episodeReplay:
+                self.replayEpisode()
         # Keep track of the number of games played, and set learning
         # parameters to zero when we are done with the pre-set number
         # of training episodes
         self.incrementEpisodesSoFar()
+        if self.converged:
+            return
+        reason = None
+        if self.track_convergence and \
+                self.getEpisodesSoFar() < self.getNumTraining():
+            reason = self.checkConvergence(state.isWin())
+        if reason is not None:
+            self.converged = True
+            self.finishTraining(reason)
+        elif self.getEpisodesSoFar() == self.getNumTraining():
+            self.finishTraining()
+        elif self.saveFile is not None and self.saveEvery > 0 and \
+                self.getEpisodesSoFar() % self.saveEvery == 0 and \
+                self.getEpisodesSoFar() < self.getNumTraining():
+            saveQTable(self.stats_acts_q_val, self.saveFile)
+
+    def checkConvergence(self, win):
+        """
+        Adds the statistics of the episode that just ended and checks if
+        training has converged
+
+        @param win: bool indicating if the episode was won
+
+        @return: description of the converged statistics, or None if
+         training has not converged yet
+        """
+        td_error = self.episode_td_error / max(self.episode_updates, 1)
+        discovery = (len(self.stats_acts_q_val) - self.episode_start_states) \
+            / float(max(self.episode_updates, 1))
+        self.episode_td_error = 0.0
+        self.episode_updates = 0
+        self.episode_start_states = len(self.stats_acts_q_val)
+
+        rate = 2.0 / (self.convergeEpisodes + 1)
+        if self.td_error_average is None:
+            self.td_error_average = td_error
+            self.discovery_average = discovery
+        else:
+            self.td_error_average += rate * (td_error - self.td_error_average)
+            self.discovery_average += rate * (discovery -
+                                              self.discovery_average)
+        self.recent_wins.append(win)
+
+        if len(self.recent_wins) < self.recent_wins.maxlen:
+            return None
+        wins = list(self.recent_wins)
+        previous_win_rate = sum(wins[:self.convergeEpisodes]) \
+            / float(self.convergeEpisodes)
+        win_rate = sum(wins[self.convergeEpisodes:]) \
+            / float(self.convergeEpisodes)
+        if self.td_error_average < self.convergeTdError and \
+                self.discovery_average < self.convergeDiscovery and \
+                abs(win_rate - previous_win_rate) <= self.convergeWinRate:
+            return ('converged after %d episodes: average TD error %.3f, '
+                    '%.4f new states per move, win rate %.2f (was %.2f)'
+                    % (self.getEpisodesSoFar(), self.td_error_average,
+                       self.discovery_average, win_rate, previous_win_rate))
+        return None
+
+    def finishTraining(self, reason=None):
+        """
+        Turns off learning once the training episodes are played, and writes
+        the q table to the checkpoint file if one is set
+
+        @param reason: description of why training stopped before all
+         training episodes were played, if it did
+        """
+        msg = 'Training Done (turning off epsilon and alpha)'
+        print '%s\n%s' % (msg, '-' * len(msg))
+        if reason is not None:
+            print 'Training stopped early, %s' % reason
+        self.setAlpha(0)
+        self.setEpsilon(0)
+        if self.compilePolicy:
+            # compiled by registerInitialState of the next game
+            self.inference = True
+            self.policy = None
+        table = self.stats_acts_q_val
+        if isinstance(table, (SymmetricQTable, AbstractQTable)):
+            table = table.table
+        print 'Q table: %d states with the %s state abstraction' % (
+            len(table), self.abstraction)
+        if isinstance(table, SharedQTable) and table.rejected.value:
+            print ('Shared q table full: %d states, %d writes of new states '
+                   'dropped' % (len(table), table.rejected.value))
+        if isinstance(table, BoundedQTable):
+            print ('Q table: %(states)d states (~%(bytes)d bytes), '
+                   '%(hits)d hits, %(misses)d misses, '
+                   '%(evictions)d evictions'
+                   % table.getStats())
+        if self.saveFile is not None and not self.readOnly:
+            saveQTable(self.stats_acts_q_val, self.saveFile)
+            print 'Saved q table of %d states to %s' % (
+                len(self.stats_acts_q_val), self.saveFile)
+
+    # Parallel training
+    #
+    # Used by parallelTraining to merge the q values learned by copies of
+    # the agent running in other processes
+    def startVisitCounts(self):
+        self.visit_counts = {}
+        self.replay_counts = {}
+
+    def takeVisitedQValues(self):
+        """
+        Gets the q values updated since the previous call, and resets the
+        counts of updates. States and actions are given as keyed by the
+        table under the symmetry or abstraction wrapper, so that the main
+        process can merge them without knowing the layout
+
+        @return: list of (state, action, q value, number of updates) tuples
+        """
+        table = self.stats_acts_q_val
+        if self.replay_counts:
+            # experience replay updates rows of the array q table, count
+            # them for the states stored in the rows
+            states = table.statesOfRows(
+                set(row for row, _ in self.replay_counts))
+            for (row, action), count in self.replay_counts.iteritems():
+                key = (states[row], action)
+                self.visit_counts[key] = self.visit_counts.get(key, 0) + count
+            self.replay_counts = {}
+        visited = []
+        for (q_state, action), count in self.visit_counts.iteritems():
+            q_value = table.getQValue(q_state, action)
+            if isinstance(table, (SymmetricQTable, AbstractQTable)):
+                q_state, action = table.key(q_state, action)
+            visited.append((q_state, action, q_value, count))
+        self.visit_counts = {}
+        return visited
+
+    def shareQTable(self, layout, numGhosts, capacity, locked=False):
+        """
+        Moves the q table into shared memory, so that copies of the agent in
+        forked processes learn from each other's updates immediately
+
+        @param layout: layout of the games
+        @param numGhosts: number of ghosts in the games
+        @param capacity: maximum number of states of the shared q table
+        @param locked: write q values under the stripe locks of the table
+        """
+        num_ghosts = numGhosts
+        food_bytes = (layout.width * layout.height + 7) // 8
+        if self.abstraction != 'exact':
+            # the shared table holds the abstract keys
+            num_ghosts, food_bytes = \
+                STATE_ABSTRACTIONS[self.abstraction].keyShape(num_ghosts,
+                                                              food_bytes)
+        shared = SharedQTable(capacity, num_ghosts, food_bytes, QState,
+                              locked)
+        for q_state, q_values in self.stats_acts_q_val.rows():
+            shared.setRow(q_state, q_values)
+        if self.symmetry:
+            shared = SymmetricQTable(shared, self.canonicalState)
+        if self.abstraction != 'exact':
+            shared = AbstractQTable(shared, self.abstractState)
+        self.stats_acts_q_val = shared
+        self.locked_updates = locked
+        self.replay = None
+
+    def setQValues(self, q_values):
+        """
+        Overwrites q values of the q table
+
+        @param q_values: list of (state, action, q value) tuples, keyed as
+         by takeVisitedQValues
+        """
+        table = self.stats_acts_q_val
+        if isinstance(table, (SymmetricQTable, AbstractQTable)):
+            table = table.table
+        for q_state, action, q_value in q_values:
+            table.setQValue(q_state, action, q_value)
+
+
+class ApproximateQAgent(EncodedStateAgent):
+    """
+    Q learning agent that approximates q values by a linear function of a few
+    features of the state and action instead of keeping a q table. The
+    weights generalize over states, so the agent learns in far fewer episodes
+    and its memory does not grow with the number of states seen. The reward
+    is the change of the game score.
+    """
+
+    # Constructor, called when we start running the game
+    def __init__(self, alpha=0.2, epsilon=0.05, gamma=0.8, numTraining=10):
+        # alpha       - learning rate
+        # epsilon     - exploration rate
+        # gamma       - discount factor
+        # numTraining - number of training episodes
+        if numpy is None:
+            raise Exception('ApproximateQAgent needs numpy')
+        EncodedStateAgent.__init__(self, alpha, epsilon, gamma, numTraining)
+
+        # weight of every feature in FEATURES
+        self.weights = numpy.zeros(len(FEATURES))
+
+        # features of the previous state and action
+        self.prev_features = None
+
+        # score of the game after the previous action
+        self.prev_score = 0
+
+    def registerInitialState(self, state):
+        EncodedStateAgent.registerInitialState(self, state)
+        self.prev_features = None
+        self.prev_score = state.getScore()
+
+    # getAction
+    #
+    # Computes the features of all legal actions at once, which gives both
+    # the value of the best next action for the update of the previous
+    # action and the q values to choose the next action from
+    def getAction(self, state):
+        legal = getLegalActionIndices(state.getLegalPacmanActions())
+
+        pacman_cell = self.encoder.cell_index(state.getPacmanPosition())
+        self.updateFood(pacman_cell)
+        features = get_features(
+            pacman_cell, self.food,
+            self.encoder.ghost_cells(state.getGhostPositions()),
+            self.encoder, legal)
+        q_values = features.dot(self.weights)
+
+        if self.prev_features is not None:
+            self.updateWeights(state.getScore(), q_values.max())
+
+        # select action based on e-greedy algorithm
+        if util.rng.random() > self.epsilon:
+            row = int(numpy.argmax(q_values))
+        else:
+            row = util.rng.choice(range(len(legal)))
+
+        self.prev_features = features[row]
+        return actionToDirection[ACTIONS[legal[row]]]
+
+    def updateWeights(self, score, max_next_q_value):
+        """
+        Updates the weights based on Q learning formula
+
+        @param score: game score after the previous action
+        @param max_next_q_value: q value of the best action after the
+         previous action, 0 in a terminal state
+        """
+        reward = score - self.prev_score
+        self.prev_score = score
+        difference = reward + self.gamma * max_next_q_value \
+            - self.prev_features.dot(self.weights)
+        self.weights += self.alpha * difference * self.prev_features
+
+    # Handle the end of episodes
+    #
+    # This is called by the game after a win, a loss or a truncation, after
+    # which the q values of the state are still bootstrapped from
+    def final(self, state):
+        if self.prev_features is not None:
+            max_next_q_value = 0.0
+            if state.isTruncated():
+                max_next_q_value = get_features(
+                    self.encoder.cell_index(state.getPacmanPosition()),
+                    self.food,
+                    self.encoder.ghost_cells(state.getGhostPositions()),
+                    self.encoder,
+                    getLegalActionIndices(state.getLegalPacmanActions())
+                ).dot(self.weights).max()
+            self.updateWeights(state.getScore(), max_next_q_value)
+            self.prev_features = None
+        self.incrementEpisodesSoFar()
         if self.getEpisodesSoFar() == self.getNumTraining():
-            msg = 'Training Done (turning off epsilon and alpha)'
-            print '%s\n%s' % (msg, '-' * len(msg))
-            self.setAlpha(0)
-            self.setEpsilon(0)
+            self.finishTraining()
+
+    def finishTraining(self):
+        """
+        Turns off learning once the training episodes are played
+        """
+        msg = 'Training Done (turning off epsilon and alpha)'
+        print '%s\n%s' % (msg, '-' * len(msg))
+        self.setAlpha(0)
+        self.setEpsilon(0)
+        print 'Weights: %s' % ', '.join(
+            '%s=%.3f' % (name, weight)
+            for name, weight in zip(FEATURES, self.weights))
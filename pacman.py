@@ -91,9 +91,11 @@ class GameState:
         else:
             return GhostRules.getLegalActions( self, agentIndex )
 
-    def generateSuccessor( self, agentIndex, action):
+    def generateSuccessor( self, agentIndex, action, trackExplored=True):
         """
         Returns the successor state after the specified agent takes the action.
+        Both states are added to the explored states unless trackExplored is
+        False, as for the moves of the game itself in headless training.
         """
         # Check that successors exist
         if self.isWin() or self.isLose(): raise Exception('Can\'t generate a successor of a terminal state.')
@@ -120,8 +122,10 @@ class GameState:
         # Book keeping
         state.data._agentMoved = agentIndex
         state.data.score += state.data.scoreChange
-        GameState.explored.add(self)
-        GameState.explored.add(state)
+        state.data.updateZobrist( self.data )
+        if trackExplored:
+            GameState.explored.add(self)
+            GameState.explored.add(state)
         return state
 
     def getLegalPacmanActions( self ):
@@ -167,6 +171,13 @@ class GameState:
     def getScore( self ):
         return float(self.data.score)
 
+    def getStateKey( self ):
+        """
+        Returns a 64 bit key of the state for transposition and learning
+        tables. Equal states have equal keys, in every process and run.
+        """
+        return self.data.stateKey()
+
     def getCapsules(self):
         """
         Returns a list of positions (x,y) of the remaining capsules.
@@ -201,10 +212,10 @@ class GameState:
         return self.data.layout.walls
 
     def hasFood(self, x, y):
-        return self.data.food[x][y]
+        return self.data.food.get(x, y)
 
     def hasWall(self, x, y):
-        return self.data.layout.walls[x][y]
+        return self.data.layout.walls.get(x, y)
 
     def isLose( self ):
         return self.data._lose
@@ -212,6 +223,13 @@ class GameState:
     def isWin( self ):
         return self.data._win
 
+    def isTruncated( self ):
+        """
+        Returns True if the game was stopped by a move or time limit before
+        it was won or lost.
+        """
+        return self.data._truncated
+
     #############################################
     #             Helper methods:               #
     # You shouldn't need to call these directly #
@@ -231,6 +249,15 @@ class GameState:
         state.data = self.data.deepCopy()
         return state
 
+    def readOnlyView( self ):
+        """
+        Returns a read only view of this state, which agents can observe
+        instead of a deep copy. The game never changes a state after
+        creating it, so the view stays valid.
+        """
+        self.data.food.freeze()
+        return GameStateView( self )
+
     def __eq__( self, other ):
         """
         Allows two states to be compared.
@@ -253,6 +280,54 @@ class GameState:
         """
         self.data.initialize(layout, numGhostAgents)
 
+class GameStateView:
+    """
+    A read only view of a GameState, observed by agents instead of a deep
+    copy of the state when the game is run with read only observations.
+
+    The accessor methods read the state itself; those that would return
+    lists or agent states of the state return copies, and the food and walls
+    grids are frozen. Setting attributes raises an AttributeError. Agents
+    reading the data attribute directly get a deep copy of it, made the first
+    time they do so.
+    """
+    def __init__( self, state ):
+        self.__dict__['_state'] = state
+
+    def __getattr__( self, name ):
+        if name == 'data':
+            data = self.__dict__['data'] = self._state.data.deepCopy()
+            return data
+        return getattr(self._state, name)
+
+    def __setattr__( self, name, value ):
+        raise AttributeError('Observations are read only, can not set ' + name)
+
+    def getGhostStates( self ):
+        return [s.copy() for s in self._state.data.agentStates[1:]]
+
+    def getGhostState( self, agentIndex ):
+        return self._state.getGhostState( agentIndex ).copy()
+
+    def getCapsules( self ):
+        return self._state.data.capsules[:]
+
+    def deepCopy( self ):
+        return self._state.deepCopy()
+
+    def __eq__( self, other ):
+        if isinstance(other, GameStateView): other = other._state
+        return self._state == other
+
+    def __ne__( self, other ):
+        return not self == other
+
+    def __hash__( self ):
+        return hash( self._state )
+
+    def __str__( self ):
+        return str( self._state )
+
 ############################################################################
 #                     THE HIDDEN SECRETS OF PACMAN                         #
 #                                                                          #
@@ -268,14 +343,21 @@ class ClassicGameRules:
     These game rules manage the control flow of a game, deciding when
     and how the game starts and ends.
     """
-    def __init__(self, timeout=30):
+    def __init__(self, timeout=30, maxMoves=0, maxSeconds=0, readOnlyObservations=False):
         self.timeout = timeout
+        # Limits of the number of moves and of the seconds of a game, 0 for
+        # no limit. A game reaching a limit ends truncated
+        self.maxMoves = maxMoves
+        self.maxSeconds = maxSeconds
+        # agents observe read only views of the states instead of copies
+        self.readOnlyObservations = readOnlyObservations
 
     def newGame( self, layout, pacmanAgent, ghostAgents, display, quiet = False, catchExceptions=False):
         agents = [pacmanAgent] + ghostAgents[:layout.getNumGhosts()]
         initState = GameState()
         initState.initialize( layout, len(ghostAgents) )
-        game = Game(agents, display, self, catchExceptions=catchExceptions)
+        game = Game(agents, display, self, catchExceptions=catchExceptions,
+                    readOnlyObservations=self.readOnlyObservations)
         game.state = initState
         self.initialState = initState.deepCopy()
         self.quiet = quiet
@@ -287,6 +369,10 @@ class ClassicGameRules:
         """
         if state.isWin(): self.win(state, game)
         if state.isLose(): self.lose(state, game)
+        if not game.gameOver:
+            if (self.maxMoves > 0 and game.numMoves >= self.maxMoves) or \
+               (self.maxSeconds > 0 and time.time() - game.startTime >= self.maxSeconds):
+                self.truncate(state, game)
 
     def win( self, state, game ):
         if not self.quiet: print "Pacman emerges victorious! Score: %d" % state.data.score
@@ -296,6 +382,11 @@ class ClassicGameRules:
         if not self.quiet: print "Pacman died! Score: %d" % state.data.score
         game.gameOver = True
 
+    def truncate( self, state, game ):
+        if not self.quiet: print "Game truncated after %d moves! Score: %d" % (game.numMoves, state.data.score)
+        state.data._truncated = True
+        game.gameOver = True
+
     def getProgress(self, game):
         return float(game.state.getNumFood()) / self.initialState.getNumFood()
 
@@ -359,10 +450,10 @@ class PacmanRules:
     def consume( position, state ):
         x,y = position
         # Eat food
-        if state.data.food[x][y]:
+        if state.data.food.get(x, y):
             state.data.scoreChange += 10
             state.data.food = state.data.food.copy()
-            state.data.food[x][y] = False
+            state.data.food.set(x, y, False)
             state.data._foodEaten = position
             # TODO: cache numFood?
             numFood = state.getNumFood()
@@ -523,6 +614,22 @@ def readCommand( argv ):
                       help='Turns on exception handling and timeouts during games', default=False)
     parser.add_option('--timeout', dest='timeout', type='int',
                       help=default('Maximum length of time an agent can spend computing in a single game'), default=30)
+    parser.add_option('--workers', dest='workers', type='int',
+                      help=default('Number of processes playing the training episodes in parallel'), default=1)
+    parser.add_option('--mergeEvery', dest='mergeEvery', type='int',
+                      help=default('Training episodes each worker plays between merges of the learned values'), default=50)
+    parser.add_option('--sharedStates', dest='sharedStates', type='int',
+                      help=default('If positive, workers update one shared table of at most this many states instead of merging'), default=0)
+    parser.add_option('--sharedLocks', action='store_true', dest='sharedLocks',
+                      help='Lock the rows of the shared table while writing them', default=False)
+    parser.add_option('--seed', dest='seed', type='int',
+                      help='Seeds the randomness of every game from this number and the number of the game', default=None)
+    parser.add_option('--maxMoves', dest='maxMoves', type='int',
+                      help=default('Maximum number of moves of a game before it is truncated, 0 for no limit'), default=0)
+    parser.add_option('--maxSeconds', dest='maxSeconds', type='float',
+                      help=default('Maximum number of seconds of a game before it is truncated, 0 for no limit'), default=0)
+    parser.add_option('--readOnlyObservations', action='store_true', dest='readOnlyObservations',
+                      help='Agents observe read only views of the game states instead of copies', default=False)
 
     options, otherjunk = parser.parse_args(argv)
     if len(otherjunk) != 0:
@@ -570,6 +677,14 @@ def readCommand( argv ):
     args['record'] = options.record
     args['catchExceptions'] = options.catchExceptions
     args['timeout'] = options.timeout
+    args['workers'] = options.workers
+    args['mergeEvery'] = options.mergeEvery
+    args['sharedStates'] = options.sharedStates
+    args['sharedLocks'] = options.sharedLocks
+    args['maxMoves'] = options.maxMoves
+    args['maxSeconds'] = options.maxSeconds
+    args['readOnlyObservations'] = options.readOnlyObservations
+    args['seed'] = options.seed
 
     # Special case: recorded games don't use the runGames method or args structure
     if options.gameToReplay != None:
@@ -625,14 +740,26 @@ def replayGame( layout, actions, display ):
 
     display.finish()
 
-def runGames( layout, pacman, ghosts, display, numGames, record, numTraining = 0, catchExceptions=False, timeout=30 ):
+def runGames( layout, pacman, ghosts, display, numGames, record, numTraining = 0, catchExceptions=False, timeout=30, workers=1, mergeEvery=50, sharedStates=0, sharedLocks=False, maxMoves=0, maxSeconds=0, seed=None, readOnlyObservations=False ):
     import __main__
     __main__.__dict__['_display'] = display
 
-    rules = ClassicGameRules(timeout)
+    rules = ClassicGameRules(timeout, maxMoves, maxSeconds, readOnlyObservations)
     games = []
-
-    for i in range( numGames ):
+    firstGame = 0
+
+    # Play the training games in worker processes
+    if workers > 1 and numTraining > 0:
+        import parallelTraining
+        rules.quiet = True
+        if seed is not None: util.seedGame(seed, 0)
+        parallelTraining.runParallelTraining(layout, pacman, ghosts, rules, min(numTraining, numGames),
+                                             workers, mergeEvery, catchExceptions, sharedStates, sharedLocks)
+        firstGame = min(numTraining, numGames)
+
+    i = firstGame
+    while i < numGames:
+        if seed is not None: util.seedGame(seed, i)
         beQuiet = i < numTraining
         if beQuiet:
                 # Suppress output and graphics
@@ -643,7 +770,10 @@ def runGames( layout, pacman, ghosts, display, numGames, record, numTraining = 0
             gameDisplay = display
             rules.quiet = False
         game = rules.newGame( layout, pacman, ghosts, gameDisplay, beQuiet, catchExceptions)
-        game.run()
+        if beQuiet and not catchExceptions:
+            game.runHeadless(recordHistory=record)
+        else:
+            game.run()
         if not beQuiet: games.append(game)
 
         if record:
@@ -654,6 +784,12 @@ def runGames( layout, pacman, ghosts, display, numGames, record, numTraining = 0
             cPickle.dump(components, f)
             f.close()
 
+        # Skip the remaining training games if the agent stopped training
+        if beQuiet and getattr(pacman, 'converged', False):
+            i = numTraining
+        else:
+            i += 1
+
     if (numGames-numTraining) > 0:
         scores = [game.state.getScore() for game in games]
         wins = [game.state.isWin() for game in games]
@@ -661,7 +797,7 @@ def runGames( layout, pacman, ghosts, display, numGames, record, numTraining = 0
         print 'Average Score:', sum(scores) / float(len(scores))
         print 'Scores:       ', ', '.join([str(score) for score in scores])
         print 'Win Rate:      %d/%d (%.2f)' % (wins.count(True), len(wins), winRate)
-        print 'Record:       ', ', '.join([ ['Loss', 'Win'][int(w)] for w in wins])
+        print 'Record:       ', ', '.join([ 'Truncated' if game.state.isTruncated() else ['Loss', 'Win'][int(w)] for game, w in zip(games, wins)])
 
     return games
 
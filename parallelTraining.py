@@ -0,0 +1,158 @@
+# parallelTraining.py
+# -------------------
+# Trains a learning pacman agent with several worker processes.
+#
+# Every worker process plays training episodes on the same layout with its
+# own copy of the pacman agent. After each worker has played mergeEvery
+# episodes, the q values the workers updated are merged into the agent of
+# the main process, weighting the value of every worker by the number of
+# times it updated it, and the merged values are sent back to all workers
+# before the next round.
+#
+# Alternatively the workers can share one q table in shared memory, see
+# SharedQTable, and learn asynchronously from each other's updates without
+# any merging.
+#
+# The pacman agent must provide startVisitCounts, takeVisitedQValues,
+# setQValues, shareQTable and finishTraining, as QLearnAgent does.
+
+from multiprocessing import Pipe, Process
+import random
+import sys
+
+import textDisplay
+import util
+
+
+def mergeQValues(visited):
+    """
+    Merges the q values updated by the workers in one round
+
+    @param visited: list with one list per worker of (state, action, q value,
+     number of updates) tuples
+
+    @return: list of (state, action, q value) tuples, where the q value is
+     the average of the workers' values weighted by their number of updates
+    """
+    totals = {}
+    for worker_visited in visited:
+        for state, action, q_value, count in worker_visited:
+            key = (state, action)
+            weighted_sum, total_count = totals.get(key, (0.0, 0))
+            totals[key] = (weighted_sum + count * q_value, total_count + count)
+    return [(state, action, weighted_sum / total_count)
+            for (state, action), (weighted_sum, total_count)
+            in totals.iteritems()]
+
+
+def _runWorker(conn, seed, layout, pacman, ghosts, rules, catchExceptions,
+               merge):
+    """
+    Main loop of a worker process. Receives the number of episodes to play
+    together with the merged q values of the previous round, and replies
+    with the q values updated while playing them, or None when the q table
+    is shared. A message of None stops the worker.
+    """
+    random.seed(seed)
+    if util.rng is not random:
+        util.rng.seed(seed)
+    try:
+        import numpy
+        numpy.random.seed(seed % (1 << 32))
+    except ImportError:
+        pass
+    if merge:
+        pacman.startVisitCounts()
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        episodes, updates = message
+        pacman.setQValues(updates)
+        for _ in range(episodes):
+            game = rules.newGame(layout, pacman, ghosts,
+                                 textDisplay.NullGraphics(), True,
+                                 catchExceptions)
+            if catchExceptions:
+                game.run()
+            else:
+                game.runHeadless()
+        conn.send(pacman.takeVisitedQValues() if merge else None)
+    conn.close()
+
+
+def runParallelTraining(layout, pacman, ghosts, rules, numTraining,
+                        numWorkers, mergeEvery, catchExceptions=False,
+                        sharedStates=0, sharedLocks=False):
+    """
+    Plays numTraining training episodes split over worker processes and
+    leaves the learned q values in the pacman agent, which then finishes
+    training as if it had played all episodes itself.
+
+    @param layout: layout of the games
+    @param pacman: pacman agent, copied into every worker
+    @param ghosts: ghost agents
+    @param rules: ClassicGameRules used to create the games
+    @param numTraining: total number of training episodes
+    @param numWorkers: number of worker processes
+    @param mergeEvery: episodes each worker plays between two merges
+    @param catchExceptions: turns on exception handling in the games
+    @param sharedStates: if positive, the workers update one shared q table
+     of at most this many states instead of merging their q values
+    @param sharedLocks: write q values of the shared q table under locks
+    """
+    if not hasattr(pacman, 'startVisitCounts'):
+        raise Exception('%s does not support parallel training'
+                        % pacman.__class__.__name__)
+    merge = sharedStates <= 0
+    if not merge:
+        pacman.shareQTable(layout, min(layout.getNumGhosts(), len(ghosts)),
+                           sharedStates, sharedLocks)
+        mergeEvery = (numTraining + numWorkers - 1) // numWorkers
+
+    # workers must not write checkpoints, the main process does so when
+    # training is done
+    saveFile = getattr(pacman, 'saveFile', None)
+    pacman.saveFile = None
+    base_seed = int(util.rng.random() * (1 << 32))
+    workers = []
+    for i in range(numWorkers):
+        parent_conn, child_conn = Pipe()
+        process = Process(target=_runWorker,
+                          args=(child_conn, base_seed + i, layout, pacman,
+                                ghosts, rules, catchExceptions, merge))
+        process.daemon = True
+        process.start()
+        child_conn.close()
+        workers.append((process, parent_conn))
+    pacman.saveFile = saveFile
+
+    try:
+        remaining = numTraining
+        updates = []
+        while remaining > 0:
+            # share the episodes of the round between the workers
+            round_episodes = min(remaining, numWorkers * mergeEvery)
+            shares = [round_episodes // numWorkers] * numWorkers
+            for i in range(round_episodes % numWorkers):
+                shares[i] += 1
+            for (_, conn), episodes in zip(workers, shares):
+                conn.send((episodes, updates))
+            visited = [conn.recv() for _, conn in workers]
+            if merge:
+                updates = mergeQValues(visited)
+                pacman.setQValues(updates)
+            remaining -= round_episodes
+    finally:
+        for process, conn in workers:
+            try:
+                conn.send(None)
+            except (IOError, EOFError):
+                pass
+            conn.close()
+        for process, _ in workers:
+            process.join()
+
+    pacman.episodesSoFar += numTraining
+    pacman.finishTraining()
+    sys.stdout.flush()
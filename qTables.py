@@ -0,0 +1,1177 @@
+# qTables.py
+# ----------
+# Storage backends for the q values learned by QLearnAgent.
+#
+# A q table maps a QState to one q value for every action the Pacman can
+# take in that state. Actions are given as column indices in the range
+# [0, NUM_ACTIONS), and states or actions that were never updated have a q
+# value of 0.
+#
+# Q tables can be written to and read from binary checkpoint files, see
+# saveQTable, loadQTable and MappedQTable.
+
+from array import array
+import binascii
+import heapq
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+from util import raiseNotDefined
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# number of actions, and so of q values, stored for every state
+NUM_ACTIONS = 4
+
+# q values of a state that is not in a table
+ZERO_ROW = (0.0,) * NUM_ACTIONS
+
+# rank of every action index when q values tie, the highest rank wins. The
+# ranks follow the order in which the game lists legal actions, West, East,
+# North then South, so that ties go to the legal action it lists last
+TIE_RANK = (2, 1, 3, 0)
+
+# approximate memory of one entry of a dictionary: a hash, a key and a value
+# reference, with the table kept at most two thirds full
+DICT_ENTRY_BYTES = 3 * 8 * 3 // 2
+
+
+def bestOfRow(q_values, actions):
+    """
+    Gets the best of the actions in one pass over the q values of a state.
+    Ties are broken in favour of the action with the highest TIE_RANK, that
+    is the action the game lists last, whatever the order of the actions
+    given.
+
+    @param q_values: sequence of the NUM_ACTIONS q values of a state
+    @param actions: list of action indices
+
+    @return: best action index and its q value, or None and 0 if there are
+     no actions
+    """
+    best_action = None
+    best_q_val = 0
+    for action in actions:
+        q_val = q_values[action]
+        if best_action is None or q_val > best_q_val or \
+                (q_val == best_q_val and
+                 TIE_RANK[action] > TIE_RANK[best_action]):
+            best_action = action
+            best_q_val = q_val
+    return best_action, best_q_val
+
+
+class QTable:
+    """
+    Base class of the q table backends. A backend must define maxAction,
+    from which the maximum q value and the best action of a state are
+    derived.
+    """
+
+    def maxAction(self, state, actions):
+        """
+        Gets the best of the actions in a state together with its q value,
+        with a single lookup of the row of the state
+
+        @param state: q state
+        @param actions: list of action indices
+
+        @return: best action index and its q value, see bestOfRow
+        """
+        raiseNotDefined()
+
+    def maxQValue(self, state, actions):
+        """
+        Gets the maximum q value of the actions in a state
+
+        @param state: q state
+        @param actions: list of action indices
+
+        @return: maximum q value, or 0 if there are no actions
+        """
+        return self.maxAction(state, actions)[1]
+
+    def bestAction(self, state, actions):
+        """
+        Gets the action with the maximum q value in a state. Ties are broken
+        as in bestOfRow.
+
+        @param state: q state
+        @param actions: list of action indices
+
+        @return: best action index, or None if there are no actions
+        """
+        return self.maxAction(state, actions)[0]
+
+
+class DictQTable(QTable):
+    """
+    Q table backed by a dictionary of states to lists of the NUM_ACTIONS q
+    values of their actions.
+    """
+
+    def __init__(self):
+        # dictionary of q states, actions and q values
+        self.q_values = {}
+
+    def __len__(self):
+        return len(self.q_values)
+
+    def getQValue(self, state, action):
+        """
+        Gets the q value of an action in a state
+
+        @param state: q state
+        @param action: action index
+
+        @return: q value, or 0 if it was never set
+        """
+        actions_q_val = self.q_values.get(state)
+        if actions_q_val is None:
+            return 0
+        return actions_q_val[action]
+
+    def setQValue(self, state, action, value):
+        """
+        Sets the q value of an action in a state
+
+        @param state: q state
+        @param action: action index
+        @param value: new q value
+        """
+        actions_q_val = self.q_values.get(state)
+        if actions_q_val is None:
+            actions_q_val = self.q_values[state] = [0.0] * NUM_ACTIONS
+        actions_q_val[action] = value
+
+    def maxAction(self, state, actions):
+        return bestOfRow(self.q_values.get(state, ZERO_ROW), actions)
+
+    def rows(self):
+        """
+        Iterates over all states in the table
+
+        @return: iterator of states and lists of their NUM_ACTIONS q values
+        """
+        for state, actions_q_val in self.q_values.iteritems():
+            yield state, list(actions_q_val)
+
+    def setRow(self, state, values):
+        """
+        Sets the q values of all actions in a state
+
+        @param state: q state
+        @param values: sequence of NUM_ACTIONS q values
+        """
+        self.q_values[state] = list(values)
+
+    def deleteState(self, state):
+        """
+        Removes a state and its q values from the table
+
+        @param state: q state
+        """
+        del self.q_values[state]
+
+    def bytesPerState(self, state):
+        """
+        Estimates the memory used by one state of the table
+
+        @param state: q state stored in the table
+
+        @return: approximate number of bytes
+        """
+        return sys.getsizeof(state) + sys.getsizeof(state.ghost_cells) + \
+            sys.getsizeof([0.0] * NUM_ACTIONS) + \
+            NUM_ACTIONS * sys.getsizeof(0.0) + DICT_ENTRY_BYTES
+
+
+class ArrayQTable(QTable):
+    """
+    Q table backed by a float32 array with one row of NUM_ACTIONS q values
+    per state, and a dictionary mapping states to row ids. The array grows
+    by doubling when it runs out of rows, and rows of deleted states are
+    reused.
+    """
+
+    def __init__(self, capacity=1024):
+        """
+        Constructor to create ArrayQTable object
+
+        @param capacity: number of rows allocated up front
+        """
+        if numpy is None:
+            raise Exception('The array q table requires numpy')
+        # dictionary of q states and their row ids
+        self.index = {}
+        self.values = numpy.zeros((max(int(capacity), 1), NUM_ACTIONS),
+                                  dtype=numpy.float32)
+        # number of rows handed out so far and rows of deleted states
+        self.num_rows = 0
+        self.free_rows = []
+
+    def __len__(self):
+        return len(self.index)
+
+    def rowId(self, state, create=True):
+        """
+        Gets the row id of a state, adding a row of zeros if the state is new
+
+        @param state: q state
+        @param create: add a row for a new state
+
+        @return: row id, or None if the state is new and create is False
+        """
+        row = self.index.get(state)
+        if row is None:
+            if not create:
+                return None
+            if self.free_rows:
+                row = self.free_rows.pop()
+            else:
+                row = self.num_rows
+                self.num_rows += 1
+                if row == len(self.values):
+                    self.values = numpy.concatenate(
+                        (self.values, numpy.zeros_like(self.values)))
+            self.index[state] = row
+        return row
+
+    def statesOfRows(self, rows):
+        """
+        Gets the states stored in some rows
+
+        @param rows: set of row ids
+
+        @return: dictionary of the states by row id
+        """
+        return dict((row, state) for state, row in self.index.iteritems()
+                    if row in rows)
+
+    def getQValue(self, state, action):
+        """
+        Gets the q value of an action in a state
+
+        @param state: q state
+        @param action: action index
+
+        @return: q value, or 0 if it was never set
+        """
+        row = self.index.get(state)
+        if row is None:
+            return 0
+        return float(self.values[row, action])
+
+    def setQValue(self, state, action, value):
+        """
+        Sets the q value of an action in a state
+
+        @param state: q state
+        @param action: action index
+        @param value: new q value
+        """
+        # rowId may grow and rebind the array of values
+        row = self.rowId(state)
+        self.values[row, action] = value
+
+    def maxAction(self, state, actions):
+        row = self.index.get(state)
+        if row is None:
+            return bestOfRow(ZERO_ROW, actions)
+        return bestOfRow(self.values[row].tolist(), actions)
+
+    def asArray(self):
+        """
+        Gets the used rows of the table, aligned with the row ids. Rows of
+        deleted states are zero.
+
+        @return: array of shape (number of rows, NUM_ACTIONS)
+        """
+        return self.values[:self.num_rows]
+
+    def rows(self):
+        """
+        Iterates over all states in the table
+
+        @return: iterator of states and lists of their NUM_ACTIONS q values
+        """
+        for state, row in self.index.iteritems():
+            yield state, self.values[row].tolist()
+
+    def setRow(self, state, values):
+        """
+        Sets the q values of all actions in a state
+
+        @param state: q state
+        @param values: sequence of NUM_ACTIONS q values
+        """
+        row = self.rowId(state)
+        self.values[row] = values
+
+    def deleteState(self, state):
+        """
+        Removes a state and its q values from the table
+
+        @param state: q state
+        """
+        row = self.index.pop(state)
+        self.values[row] = 0
+        self.free_rows.append(row)
+
+    def bytesPerState(self, state):
+        """
+        Estimates the memory used by one state of the table
+
+        @param state: q state stored in the table
+
+        @return: approximate number of bytes
+        """
+        return sys.getsizeof(state) + sys.getsizeof(state.ghost_cells) + \
+            sys.getsizeof(0) + self.values.itemsize * NUM_ACTIONS + \
+            DICT_ENTRY_BYTES
+
+
+# row id of a next state without a row in the replay buffer
+ABSENT_ROW = -1
+
+
+class ReplayBuffer:
+    """
+    Ring buffer of transitions between rows of an ArrayQTable, stored in
+    preallocated arrays. Batches of transitions are replayed with one
+    vectorized q learning update over the q value array.
+    """
+
+    def __init__(self, capacity, seed=None):
+        """
+        Constructor to create ReplayBuffer object
+
+        @param capacity: maximum number of transitions, older transitions
+         are overwritten
+        @param seed: seed of the generator sampling the batches
+        """
+        if numpy is None:
+            raise Exception('The replay buffer requires numpy')
+        capacity = int(capacity)
+        self.states = numpy.zeros(capacity, dtype=numpy.int32)
+        self.actions = numpy.zeros(capacity, dtype=numpy.int8)
+        self.rewards = numpy.zeros(capacity, dtype=numpy.float32)
+        self.next_states = numpy.zeros(capacity, dtype=numpy.int32)
+        self.legal = numpy.zeros((capacity, NUM_ACTIONS), dtype=numpy.bool_)
+        self.size = 0
+        self.position = 0
+        self.seed(seed)
+
+    def seed(self, seed=None):
+        """
+        Restarts the generator sampling the batches
+
+        @param seed: int seed below 2**32, or None to seed from the system
+        """
+        self.random = numpy.random.RandomState(seed)
+
+    def __len__(self):
+        return self.size
+
+    def add(self, state, action, reward, next_state, legal):
+        """
+        Stores a transition, overwriting the oldest one when the buffer is
+        full
+
+        @param state: row id of the state the action was taken in
+        @param action: action index
+        @param reward: reward received for the action
+        @param next_state: row id of the state after the action, or
+         ABSENT_ROW if the state has no row, in which case the q values of
+         its actions are 0
+        @param legal: legal action indices after the action
+        """
+        i = self.position
+        self.states[i] = state
+        self.actions[i] = action
+        self.rewards[i] = reward
+        self.next_states[i] = next_state
+        self.legal[i] = False
+        self.legal[i, legal] = True
+        self.position = (i + 1) % len(self.states)
+        self.size = min(self.size + 1, len(self.states))
+
+    def replay(self, values, batch_size, alpha, gamma):
+        """
+        Applies the q learning update to a random batch of transitions. The
+        targets of the whole batch are computed from the q values before the
+        update, and when a state and action appear several times in the
+        batch the last update wins.
+
+        @param values: q value array of the ArrayQTable the row ids refer to
+        @param batch_size: number of transitions in the batch
+        @param alpha: learning rate
+        @param gamma: discount factor
+
+        @return: arrays of the row ids and action indices of the batch
+        """
+        batch = self.random.randint(0, self.size, batch_size)
+        states = self.states[batch]
+        actions = self.actions[batch]
+        legal = self.legal[batch]
+        next_states = self.next_states[batch]
+        next_q_values = numpy.where(legal, values[next_states],
+                                    -numpy.inf).max(axis=1)
+        next_q_values[~legal.any(axis=1) | (next_states == ABSENT_ROW)] = 0
+        q_values = values[states, actions]
+        values[states, actions] = q_values + alpha * (
+            self.rewards[batch] + gamma * next_q_values - q_values)
+        return states, actions
+
+
+class BoundedQTable:
+    """
+    Q table wrapper that keeps at most a fixed number of states in another
+    q table. When the table is full, the lowest scoring tenth of the states
+    is evicted at once, where the score of a state is the time of its last
+    access for the 'lru' policy or the number of accesses for 'lfu'.
+    """
+
+    def __init__(self, table, maxStates=None, maxBytes=None, policy='lru',
+                 onEvict=None):
+        """
+        Constructor to create BoundedQTable object
+
+        @param table: q table the states are stored in
+        @param maxStates: maximum number of states
+        @param maxBytes: maximum memory used by the states, converted to a
+         number of states with the estimate of the wrapped table
+        @param policy: eviction policy, 'lru' or 'lfu'
+        @param onEvict: function called with the states left in the table
+         after states are evicted, or None
+        """
+        if policy not in ('lru', 'lfu'):
+            raise Exception('Unknown eviction policy "%s", expected lru or '
+                            'lfu' % policy)
+        if maxStates is None and maxBytes is None:
+            raise Exception('A bounded q table needs maxStates or maxBytes')
+        self.table = table
+        self.policy = policy
+        self.on_evict = onEvict
+        self.max_states = maxStates
+        self.max_bytes = maxBytes
+        self.state_bytes = None
+        # dictionary of q states and their eviction scores
+        self.scores = {}
+        self.clock = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.table)
+
+    def touch(self, state):
+        """
+        Updates the eviction score of a state on access and counts the hit
+        or miss
+
+        @param state: q state that is accessed
+        """
+        if state in self.scores:
+            self.hits += 1
+            if self.policy == 'lru':
+                self.clock += 1
+                self.scores[state] = self.clock
+            else:
+                self.scores[state] += 1
+        else:
+            self.misses += 1
+
+    def admit(self, state):
+        """
+        Makes room for a state that is about to be stored
+
+        @param state: q state that is stored
+        """
+        if state in self.scores:
+            return
+        if self.state_bytes is None:
+            self.state_bytes = self.table.bytesPerState(state) + \
+                sys.getsizeof(0) + DICT_ENTRY_BYTES
+            if self.max_bytes is not None:
+                max_states = max(1, self.max_bytes // self.state_bytes)
+                if self.max_states is None or max_states < self.max_states:
+                    self.max_states = max_states
+        if len(self.scores) >= self.max_states:
+            self.evict(max(1, self.max_states // 10))
+        self.clock += 1
+        self.scores[state] = self.clock if self.policy == 'lru' else 1
+
+    def evict(self, count):
+        """
+        Removes the states with the lowest scores
+
+        @param count: number of states to remove
+        """
+        for state, _ in heapq.nsmallest(count, self.scores.iteritems(),
+                                        key=lambda item: item[1]):
+            del self.scores[state]
+            self.table.deleteState(state)
+            self.evictions += 1
+        if self.on_evict is not None:
+            self.on_evict(self.scores)
+
+    def getQValue(self, state, action):
+        self.touch(state)
+        return self.table.getQValue(state, action)
+
+    def setQValue(self, state, action, value):
+        self.admit(state)
+        self.table.setQValue(state, action, value)
+
+    def maxAction(self, state, actions):
+        self.touch(state)
+        return self.table.maxAction(state, actions)
+
+    def maxQValue(self, state, actions):
+        self.touch(state)
+        return self.table.maxQValue(state, actions)
+
+    def bestAction(self, state, actions):
+        self.touch(state)
+        return self.table.bestAction(state, actions)
+
+    def rows(self):
+        return self.table.rows()
+
+    def setRow(self, state, values):
+        self.admit(state)
+        self.table.setRow(state, values)
+
+    def getStats(self):
+        """
+        Gets the counters of the table
+
+        @return: dictionary of hits, misses, evictions, resident states and
+         approximate resident bytes
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'states': len(self.table),
+            'bytes': len(self.table) * (self.state_bytes or 0),
+        }
+
+
+class SymmetricQTable:
+    """
+    Q table wrapper that stores the q values of symmetric states only once.
+    Every state is mapped to a canonical state by a function given by the
+    agent, which also gives the permutation of the action indices from the
+    state to the canonical state. The wrapped table only ever sees canonical
+    states and their actions.
+    """
+
+    def __init__(self, table, canonical):
+        """
+        Constructor to create SymmetricQTable object
+
+        @param table: q table the canonical states are stored in
+        @param canonical: function of a state returning the canonical state
+         and the list of canonical action indices by action index
+        """
+        self.table = table
+        self.canonical = canonical
+
+    def __len__(self):
+        return len(self.table)
+
+    def key(self, state, action):
+        """
+        Gets the key of a state and action in the wrapped table
+
+        @param state: q state
+        @param action: action index
+
+        @return: canonical state and canonical action index
+        """
+        state, actions = self.canonical(state)
+        return state, actions[action]
+
+    def getQValue(self, state, action):
+        state, actions = self.canonical(state)
+        return self.table.getQValue(state, actions[action])
+
+    def setQValue(self, state, action, value):
+        state, actions = self.canonical(state)
+        self.table.setQValue(state, actions[action], value)
+
+    def addQValue(self, state, action, delta):
+        state, actions = self.canonical(state)
+        self.table.addQValue(state, actions[action], delta)
+
+    def maxAction(self, state, legal):
+        # ties are broken between the actions of the state itself, not
+        # between their mirrored actions
+        state, actions = self.canonical(state)
+        q_values = [0.0] * NUM_ACTIONS
+        for action in legal:
+            q_values[action] = self.table.getQValue(state, actions[action])
+        return bestOfRow(q_values, legal)
+
+    def maxQValue(self, state, legal):
+        return self.maxAction(state, legal)[1]
+
+    def bestAction(self, state, legal):
+        return self.maxAction(state, legal)[0]
+
+    def rows(self):
+        return self.table.rows()
+
+    def setRow(self, state, values):
+        state, actions = self.canonical(state)
+        canonical_values = [0.0] * NUM_ACTIONS
+        for action, value in enumerate(values):
+            canonical_values[actions[action]] = value
+        self.table.setRow(state, canonical_values)
+
+
+class AbstractQTable:
+    """
+    Q table wrapper that stores q values under abstract keys of the states,
+    given by a state abstraction of the agent. All states with the same key
+    share one row, trading the fidelity of the q values for a smaller table.
+    """
+
+    def __init__(self, table, abstract):
+        """
+        Constructor to create AbstractQTable object
+
+        @param table: q table the abstract keys are stored in
+        @param abstract: function of a state returning its abstract key
+        """
+        self.table = table
+        self.abstract = abstract
+
+    def __len__(self):
+        return len(self.table)
+
+    def key(self, state, action):
+        """
+        Gets the key of a state and action in the wrapped table
+
+        @param state: q state
+        @param action: action index
+
+        @return: abstract key of the state and the action index
+        """
+        return self.abstract(state), action
+
+    def getQValue(self, state, action):
+        return self.table.getQValue(self.abstract(state), action)
+
+    def setQValue(self, state, action, value):
+        self.table.setQValue(self.abstract(state), action, value)
+
+    def addQValue(self, state, action, delta):
+        self.table.addQValue(self.abstract(state), action, delta)
+
+    def maxAction(self, state, legal):
+        return self.table.maxAction(self.abstract(state), legal)
+
+    def maxQValue(self, state, legal):
+        return self.table.maxQValue(self.abstract(state), legal)
+
+    def bestAction(self, state, legal):
+        return self.table.bestAction(self.abstract(state), legal)
+
+    def rows(self):
+        return self.table.rows()
+
+    def setRow(self, state, values):
+        self.table.setRow(self.abstract(state), values)
+
+
+def parseSize(size):
+    """
+    Parses a number of bytes with an optional K, M or G suffix
+
+    @param size: string like '512M', or a number
+
+    @return: number of bytes
+    """
+    size = str(size).strip().upper()
+    for suffix, factor in (('K', 1 << 10), ('M', 1 << 20), ('G', 1 << 30)):
+        if size.endswith(suffix):
+            return int(float(size[:-len(suffix)]) * factor)
+    return int(size)
+
+
+# Checkpoint file layout, all numbers little-endian:
+#   header   CHECKPOINT_HEADER
+#   keys     one fixed-width record per state: the Pacman cell and the ghost
+#            cells as int32, followed by the food bitmask as big-endian
+#            bytes padded to the same width for every state
+#   values   NUM_ACTIONS float32 q values per state, in the order of keys
+#   slots    open addressing hash index of the keys, int32 row ids with
+#            EMPTY_SLOT for free slots; a key starts probing at the slot
+#            given by the crc32 of its record
+CHECKPOINT_MAGIC = 'QTBL'
+CHECKPOINT_VERSION = 1
+# magic, version, number of states, number of ghosts, food bytes per key,
+# number of slots
+CHECKPOINT_HEADER = struct.Struct('<4sIQIIQ')
+EMPTY_SLOT = -1
+
+
+def packState(state, num_ghosts, food_bytes):
+    """
+    Packs a q state into a fixed-width checkpoint key record
+
+    @param state: q state
+    @param num_ghosts: number of ghosts of every state in the checkpoint
+    @param food_bytes: number of bytes of the food bitmask
+
+    @return: key record, or None if the state does not fit the widths
+    """
+    if len(state.ghost_cells) != num_ghosts or \
+            state.food.bit_length() > 8 * food_bytes:
+        return None
+    food = '%x' % state.food
+    return struct.pack('<%di' % (1 + num_ghosts),
+                       state.pacman_cell, *state.ghost_cells) + \
+           binascii.unhexlify(food.zfill(2 * food_bytes))
+
+
+def unpackState(record, num_ghosts, make_state, food_sets=None):
+    """
+    Unpacks a q state from a checkpoint key record
+
+    @param record: key record
+    @param num_ghosts: number of ghosts of the state
+    @param make_state: function creating a q state from the Pacman cell,
+     the tuple of ghost cells and the food bitmask
+    @param food_sets: optional dictionary used to intern the food bitmasks
+
+    @return: q state
+    """
+    cells_size = 4 * (1 + num_ghosts)
+    cells = struct.unpack('<%di' % (1 + num_ghosts), record[:cells_size])
+    food = int(binascii.hexlify(record[cells_size:]), 16)
+    if food_sets is not None:
+        food = food_sets.setdefault(food, food)
+    return make_state(cells[0], cells[1:], food)
+
+
+def _slotOf(record, num_slots):
+    """
+    Gets the first slot probed for a key record
+
+    @param record: key record
+    @param num_slots: number of slots, a power of two
+
+    @return: slot index
+    """
+    return (zlib.crc32(record) & 0xffffffff) & (num_slots - 1)
+
+
+def saveQTable(stats_acts_q_val, path):
+    """
+    Writes a q table to a checkpoint file. The file is written next to the
+    destination and renamed into place, so readers never see a partial
+    checkpoint.
+
+    @param stats_acts_q_val: q table with QState keys
+    @param path: path of the checkpoint file
+    """
+    rows = list(stats_acts_q_val.rows())
+    num_ghosts = len(rows[0][0].ghost_cells) if rows else 0
+    food_bits = max([state.food.bit_length() for state, _ in rows] or [0])
+    food_bytes = max(1, (food_bits + 7) // 8)
+
+    num_slots = 1
+    while num_slots < 2 * len(rows):
+        num_slots *= 2
+    slots = array('i', [EMPTY_SLOT]) * num_slots
+    records = []
+    values = array('f')
+    for row, (state, q_values) in enumerate(rows):
+        record = packState(state, num_ghosts, food_bytes)
+        if record is None:
+            raise Exception('States of a checkpoint must have the same '
+                            'number of ghosts')
+        slot = _slotOf(record, num_slots)
+        while slots[slot] != EMPTY_SLOT:
+            slot = (slot + 1) & (num_slots - 1)
+        slots[slot] = row
+        records.append(record)
+        values.extend(q_values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+        slots.byteswap()
+
+    tmp_path = path + '.tmp'
+    f = open(tmp_path, 'wb')
+    try:
+        f.write(CHECKPOINT_HEADER.pack(CHECKPOINT_MAGIC, CHECKPOINT_VERSION,
+                                       len(rows), num_ghosts, food_bytes,
+                                       num_slots))
+        f.write(''.join(records))
+        f.write(values.tostring())
+        f.write(slots.tostring())
+    finally:
+        f.close()
+    os.rename(tmp_path, path)
+
+
+class MappedQTable(QTable):
+    """
+    Read-only q table that memory-maps a checkpoint file. States are looked
+    up through the hash index stored in the file, so opening the table does
+    not read the checkpoint and processes mapping the same file share one
+    copy of it in the page cache.
+    """
+
+    def __init__(self, path):
+        """
+        Constructor to create MappedQTable object
+
+        @param path: path of the checkpoint file
+        """
+        f = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        magic, version, self.num_rows, self.num_ghosts, self.food_bytes, \
+            self.num_slots = CHECKPOINT_HEADER.unpack_from(self.map, 0)
+        if magic != CHECKPOINT_MAGIC or version != CHECKPOINT_VERSION:
+            raise Exception('%s is not a q table checkpoint' % path)
+        self.record_size = 4 * (1 + self.num_ghosts) + self.food_bytes
+        self.keys_offset = CHECKPOINT_HEADER.size
+        self.values_offset = self.keys_offset + \
+            self.num_rows * self.record_size
+        self.slots_offset = self.values_offset + \
+            self.num_rows * NUM_ACTIONS * 4
+        self.row_struct = struct.Struct('<%df' % NUM_ACTIONS)
+        self.slot_struct = struct.Struct('<i')
+
+    def __len__(self):
+        return self.num_rows
+
+    def rowId(self, state):
+        """
+        Gets the row id of a state
+
+        @param state: q state
+
+        @return: row id, or None if the state is not in the checkpoint
+        """
+        record = packState(state, self.num_ghosts, self.food_bytes)
+        if record is None or not self.num_rows:
+            return None
+        slot = _slotOf(record, self.num_slots)
+        while True:
+            row = self.slot_struct.unpack_from(
+                self.map, self.slots_offset + 4 * slot)[0]
+            if row == EMPTY_SLOT:
+                return None
+            start = self.keys_offset + row * self.record_size
+            if self.map[start:start + self.record_size] == record:
+                return row
+            slot = (slot + 1) & (self.num_slots - 1)
+
+    def getRow(self, row):
+        """
+        Gets the q values of a row
+
+        @param row: row id
+
+        @return: tuple of NUM_ACTIONS q values
+        """
+        return self.row_struct.unpack_from(
+            self.map, self.values_offset + row * NUM_ACTIONS * 4)
+
+    def getQValue(self, state, action):
+        """
+        Gets the q value of an action in a state
+
+        @param state: q state
+        @param action: action index
+
+        @return: q value, or 0 if the state is not in the checkpoint
+        """
+        row = self.rowId(state)
+        if row is None:
+            return 0
+        return self.getRow(row)[action]
+
+    def setQValue(self, state, action, value):
+        raise Exception('A memory-mapped q table is read-only')
+
+    def setRow(self, state, values):
+        raise Exception('A memory-mapped q table is read-only')
+
+    def maxAction(self, state, actions):
+        row = self.rowId(state)
+        if row is None:
+            return bestOfRow(ZERO_ROW, actions)
+        return bestOfRow(self.getRow(row), actions)
+
+    def rows(self, make_state):
+        """
+        Iterates over all states in the checkpoint
+
+        @param make_state: function creating a q state from the Pacman cell,
+         the tuple of ghost cells and the food bitmask
+
+        @return: iterator of states and tuples of their NUM_ACTIONS q values
+        """
+        food_sets = {}
+        for row in range(self.num_rows):
+            start = self.keys_offset + row * self.record_size
+            yield unpackState(self.map[start:start + self.record_size],
+                              self.num_ghosts, make_state, food_sets), \
+                self.getRow(row)
+
+    def close(self):
+        self.map.close()
+
+
+class SharedQTable(QTable):
+    """
+    Q table in shared memory, updated concurrently by forked training
+    processes. A state is placed in a fixed array of slots by open
+    addressing on the hash of its checkpoint key record, so every process
+    finds the same slot without a shared dictionary, and the slot doubles
+    as the row id of the q values.
+
+    Claiming a free slot for a new state is done under one of a number of
+    striped locks. The key record is written before the fingerprint that
+    marks the slot as used, so other processes never match a partly written
+    key. Q values are written without locks, Hogwild style, unless the
+    table is created with locked=True, in which case writes to a row take
+    the lock of its stripe, and addQValue reads and writes a q value under
+    it.
+
+    Once the table holds capacity states, new states are no longer stored:
+    their q values read as 0 and writes to them are dropped and counted in
+    rejected.
+    """
+
+    def __init__(self, capacity, num_ghosts, food_bytes, make_state,
+                 locked=False, stripes=64):
+        """
+        Constructor to create SharedQTable object. It must be created before
+        the training processes are forked.
+
+        @param capacity: maximum number of states
+        @param num_ghosts: number of ghosts of every state
+        @param food_bytes: number of bytes of the food bitmask of a state
+        @param make_state: function creating a q state from the Pacman cell,
+         the tuple of ghost cells and the food bitmask
+        @param locked: write q values under the stripe locks
+        @param stripes: number of locks the slots are striped over
+        """
+        import ctypes
+        from multiprocessing import Lock, RawArray, Value
+        self.capacity = int(capacity)
+        self.num_slots = 1
+        while self.num_slots < 2 * self.capacity:
+            self.num_slots *= 2
+        self.num_ghosts = num_ghosts
+        self.food_bytes = food_bytes
+        self.record_size = 4 * (1 + num_ghosts) + food_bytes
+        self.make_state = make_state
+        self.locked = locked
+        # fingerprint of the key of every slot, 0 for free slots
+        self.fingerprints = RawArray(ctypes.c_int64, self.num_slots)
+        self.records = RawArray(ctypes.c_char,
+                                self.num_slots * self.record_size)
+        self.values = RawArray(ctypes.c_float, self.num_slots * NUM_ACTIONS)
+        self.size = Value(ctypes.c_long, 0)
+        # number of writes dropped because the table was full
+        self.rejected = Value(ctypes.c_long, 0)
+        self.locks = [Lock() for _ in range(stripes)]
+
+    def __len__(self):
+        return self.size.value
+
+    def rowId(self, state, create=True):
+        """
+        Gets the slot of a state, claiming a free slot if the state is new
+
+        @param state: q state
+        @param create: claim a slot for a new state
+
+        @return: slot index, or None if the state is new and create is False
+         or the table is full
+        """
+        record = packState(state, self.num_ghosts, self.food_bytes)
+        if record is None:
+            raise Exception('State does not match the shared q table layout')
+        fingerprint = hash(record) or 1
+        slot = fingerprint & (self.num_slots - 1)
+        while True:
+            slot_fingerprint = self.fingerprints[slot]
+            if slot_fingerprint == 0:
+                if not create:
+                    return None
+                with self.locks[slot % len(self.locks)]:
+                    if self.fingerprints[slot] == 0:
+                        with self.size.get_lock():
+                            if self.size.value >= self.capacity:
+                                with self.rejected.get_lock():
+                                    self.rejected.value += 1
+                                return None
+                            self.size.value += 1
+                        start = slot * self.record_size
+                        self.records[start:start + self.record_size] = record
+                        self.fingerprints[slot] = fingerprint
+                        return slot
+                    slot_fingerprint = self.fingerprints[slot]
+            if slot_fingerprint == fingerprint:
+                start = slot * self.record_size
+                if self.records[start:start + self.record_size] == record:
+                    return slot
+            slot = (slot + 1) & (self.num_slots - 1)
+
+    def getRow(self, row):
+        """
+        Gets the q values of a row
+
+        @param row: row id
+
+        @return: list of NUM_ACTIONS q values
+        """
+        return self.values[row * NUM_ACTIONS:(row + 1) * NUM_ACTIONS]
+
+    def getQValue(self, state, action):
+        """
+        Gets the q value of an action in a state
+
+        @param state: q state
+        @param action: action index
+
+        @return: q value, or 0 if it was never set
+        """
+        row = self.rowId(state, False)
+        if row is None:
+            return 0
+        return self.values[row * NUM_ACTIONS + action]
+
+    def setQValue(self, state, action, value):
+        """
+        Sets the q value of an action in a state
+
+        @param state: q state
+        @param action: action index
+        @param value: new q value
+        """
+        row = self.rowId(state)
+        if row is None:
+            return
+        if self.locked:
+            with self.locks[row % len(self.locks)]:
+                self.values[row * NUM_ACTIONS + action] = value
+        else:
+            self.values[row * NUM_ACTIONS + action] = value
+
+    def addQValue(self, state, action, delta):
+        """
+        Adds to the q value of an action in a state. The q value is read and
+        written under the lock of its stripe if the table is locked, so no
+        concurrent update of it is lost
+
+        @param state: q state
+        @param action: action index
+        @param delta: change of the q value
+        """
+        row = self.rowId(state)
+        if row is None:
+            return
+        index = row * NUM_ACTIONS + action
+        if self.locked:
+            with self.locks[row % len(self.locks)]:
+                self.values[index] += delta
+        else:
+            self.values[index] += delta
+
+    def maxAction(self, state, actions):
+        row = self.rowId(state, False)
+        if row is None:
+            return bestOfRow(ZERO_ROW, actions)
+        return bestOfRow(self.getRow(row), actions)
+
+    def rows(self):
+        """
+        Iterates over all states in the table
+
+        @return: iterator of states and lists of their NUM_ACTIONS q values
+        """
+        for slot in xrange(self.num_slots):
+            if self.fingerprints[slot] != 0:
+                start = slot * self.record_size
+                yield unpackState(self.records[start:start + self.record_size],
+                                  self.num_ghosts, self.make_state), \
+                    self.getRow(slot)
+
+    def setRow(self, state, values):
+        """
+        Sets the q values of all actions in a state
+
+        @param state: q state
+        @param values: sequence of NUM_ACTIONS q values
+        """
+        row = self.rowId(state)
+        if row is None:
+            return
+        if self.locked:
+            with self.locks[row % len(self.locks)]:
+                self.values[row * NUM_ACTIONS:(row + 1) * NUM_ACTIONS] = \
+                    list(values)
+        else:
+            self.values[row * NUM_ACTIONS:(row + 1) * NUM_ACTIONS] = \
+                list(values)
+
+
+def loadQTable(path, stats_acts_q_val, make_state):
+    """
+    Reads all q values of a checkpoint file into a q table
+
+    @param path: path of the checkpoint file
+    @param stats_acts_q_val: q table the q values are stored in
+    @param make_state: function creating a q state from the Pacman cell,
+     the tuple of ghost cells and the food bitmask
+    """
+    checkpoint = MappedQTable(path)
+    try:
+        for state, q_values in checkpoint.rows(make_state):
+            stats_acts_q_val.setRow(state, q_values)
+    finally:
+        checkpoint.close()
+
+
+# q table backends that can be selected with the qTable agent argument
+Q_TABLES = {
+    'dict': DictQTable,
+    'array': ArrayQTable,
+}
+
+
+def makeQTable(name, **kwargs):
+    """
+    Creates an empty q table
+
+    @param name: name of the backend in Q_TABLES
+    @param kwargs: arguments passed to the backend constructor
+
+    @return: q table object
+    """
+    if name not in Q_TABLES:
+        raise Exception('Unknown q table "%s", expected one of: %s'
+                        % (name, ', '.join(sorted(Q_TABLES))))
+    return Q_TABLES[name](**kwargs)
@@ -452,10 +452,23 @@ def normalize(vectorOrCounter):
         if s == 0: return vector
         return [el / s for el in vector]
 
+# Source of randomness of the agents and ghosts: the random module, or a
+# random.Random reseeded for every game when games are played with a seed
+rng = random
+
+def seedGame(seed, game):
+    """
+    Makes the randomness of a game depend only on the seed and the number
+    of the game, so that every game can be replayed on its own.
+    """
+    global rng
+    if rng is random: rng = random.Random()
+    rng.seed(seed * 1000003 + game)
+
 def nSample(distribution, values, n):
     if sum(distribution) != 1:
         distribution = normalize(distribution)
-    rand = [random.random() for i in range(n)]
+    rand = [rng.random() for i in range(n)]
     rand.sort()
     samples = []
     samplePos, distPos, cdf = 0,0, distribution[0]
@@ -475,7 +488,7 @@ def sample(distribution, values = None):
         values = [i[0] for i in items]
     if sum(distribution) != 1:
         distribution = normalize(distribution)
-    choice = random.random()
+    choice = rng.random()
     i, total= 0, distribution[0]
     while choice > total:
         i += 1
@@ -498,14 +511,14 @@ def getProbability(value, distribution, values):
     return total
 
 def flipCoin( p ):
-    r = random.random()
+    r = rng.random()
     return r < p
 
 def chooseFromDistribution( distribution ):
     "Takes either a counter or a list of (prob, key) pairs and samples"
     if type(distribution) == dict or type(distribution) == Counter:
         return sample(distribution)
-    r = random.random()
+    r = rng.random()
     base = 0.0
     for prob, element in distribution:
         base += prob